@@ -0,0 +1,104 @@
+"""
+Columnar coordinate files consist of
+- MAGIC
+- the length of the header as little endian uint64
+- the JSON header, padded with spaces to a multiple of 8 bytes
+- for every line, the COLUMNS as consecutive little endian float64 arrays
+
+The header holds the poi and markers as they are, and for every line the offset and
+number of its points as well as the non-column fields of points which differ from
+DEFAULT_EXTRAS.
+"""
+
+import json
+import struct
+import numpy as np
+
+MAGIC = b"MZBCOL1\0"
+COLUMNS = ("easting", "northing", "dist", "alt")
+# Point fields which are not stored in a column, points with only these values need no entry
+DEFAULT_EXTRAS = {"relative": None}
+
+
+def writeColumnar(f, coordinate_data):
+    lines = {}
+    blocks = []
+    offset = 0
+    for key, line in coordinate_data["coords"].items():
+        block = np.empty((len(COLUMNS), len(line)), dtype="<f8")
+        for i, column in enumerate(COLUMNS):
+            block[i] = [np.nan if p.get(column) is None else p[column] for p in line]
+
+        extras = {}
+        for i, p in enumerate(line):
+            extra = {k: v for k, v in p.items() if k not in COLUMNS}
+            if extra != DEFAULT_EXTRAS:
+                extras[i] = extra
+
+        lines[key] = {"offset": offset, "count": len(line), "extras": extras}
+        blocks.append(block)
+        offset += block.nbytes
+
+    header = json.dumps(
+        {
+            "columns": COLUMNS,
+            "lines": lines,
+            "poi": coordinate_data["poi"],
+            "markers": coordinate_data["markers"],
+        }
+    ).encode()
+    header += b" " * (-len(header) % 8)
+
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for block in blocks:
+        f.write(block.tobytes())
+
+
+def readHeader(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a columnar coordinate file")
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    header["data_offset"] = len(MAGIC) + 8 + length
+    return header
+
+
+def readLineColumns(path, line_name, header=None):
+    """
+    Returns the columns of one line as read-only arrays memory-mapped from the file,
+    without reading any other line
+    """
+    if header is None:
+        header = readHeader(path)
+    line = header["lines"][line_name]
+    if line["count"] == 0:
+        return {column: np.empty(0) for column in COLUMNS}
+    block = np.memmap(
+        path,
+        dtype="<f8",
+        mode="r",
+        offset=header["data_offset"] + line["offset"],
+        shape=(len(COLUMNS), line["count"]),
+    )
+    return dict(zip(COLUMNS, block))
+
+
+def readColumnar(path):
+    header = readHeader(path)
+    coords = {}
+    for key, line in header["lines"].items():
+        columns = readLineColumns(path, key, header)
+        values = [
+            [None if v != v else v for v in columns[column].tolist()]
+            for column in COLUMNS
+        ]
+        points = []
+        for i, row in enumerate(zip(*values)):
+            p = dict(zip(COLUMNS, row))
+            p.update(line["extras"].get(str(i), DEFAULT_EXTRAS))
+            points.append(p)
+        coords[key] = points
+    return {"coords": coords, "poi": header["poi"], "markers": header["markers"]}
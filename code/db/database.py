@@ -1,3 +1,24 @@
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# How long a connection waits for the lock of another writer before giving up
+SQLITE_BUSY_TIMEOUT_MS = 15000
 
 db = SQLAlchemy()
+
+
+@event.listens_for(Engine, "connect")
+def setSqlitePragmas(dbapi_connection, connection_record):
+    """
+    With the write-ahead log readers do not block the writer and the other way
+    around, which several worker processes on one database need
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
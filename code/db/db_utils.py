@@ -1,18 +1,237 @@
+import contextlib
 import json
 import os
+import tempfile
+import numpy as np
+from db.columnar import COLUMNS, writeColumnar, readColumnar, readLineColumns
+from db.oplog import applyOperation
+from db.document_cache import document_cache, documentSize, copyDocument
+
+try:
+    import fcntl
+except ImportError:
+    # Without advisory locks, only a single process may write the documents
+    fcntl = None
 
 JSON_FILE_LOCATION = "db/json/"
+COLUMNAR_FILE_LOCATION = "db/columnar/"
+OPLOG_FILE_LOCATION = "db/json/"
+LOCK_FILE_LOCATION = "db/json/"
+# Once the operation log of a file grows beyond this, it is folded into the document
+OPLOG_COMPACT_BYTES = 64 * 1024
+
+# Times a read-modify-write is tried optimistically before it holds the lock throughout
+UPDATE_RETRIES = 3
+
+# "json" or "columnar", decides the format new data is saved in
+STORAGE_BACKEND = os.environ.get("MZB_STORAGE_BACKEND", "json")
+
+
+def jsonPath(name):
+    return JSON_FILE_LOCATION + name + ".json"
+
+
+def columnarPath(name):
+    return COLUMNAR_FILE_LOCATION + name + ".bin"
+
+
+def oplogPath(name):
+    return OPLOG_FILE_LOCATION + name + ".log"
+
+
+def lockPath(name):
+    return LOCK_FILE_LOCATION + name + ".lock"
+
+
+@contextlib.contextmanager
+def fileLock(name, exclusive=True):
+    """
+    Advisory lock of the files of a document, held by every writer exclusively and
+    by readers shared, across threads and processes. It is not reentrant.
+    Lock files are never removed, a process waiting on a removed one would not
+    exclude a process locking its replacement.
+    """
+    if fcntl is None:
+        yield
+        return
+    if exclusive:
+        os.makedirs(LOCK_FILE_LOCATION, exist_ok=True)
+        f = open(lockPath(name), "a")
+    else:
+        try:
+            f = open(lockPath(name), "r")
+        except FileNotFoundError:
+            f = None
+    if f is None:
+        # Nothing was ever written under the lock, readers do not create it
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def atomicWrite(path, write, binary=False):
+    """
+    Writes a file through write(f) into a temporary file next to it, which then
+    replaces it, so readers see either the old or the new file and never part of one
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 
 def saveCoordinateData(name, coordinate_data):
-    with open(JSON_FILE_LOCATION + name + ".json", "w") as f:
-        json.dump(coordinate_data, f)
+    """Writes the whole document, which already contains all logged operations"""
+    with fileLock(name):
+        writeDocument(name, coordinate_data)
+
+
+def writeDocument(name, coordinate_data):
+    """saveCoordinateData, for callers holding the lock"""
+    if STORAGE_BACKEND == "columnar":
+        atomicWrite(
+            columnarPath(name), lambda f: writeColumnar(f, coordinate_data), True
+        )
+        stale = jsonPath(name)
+    else:
+        atomicWrite(jsonPath(name), lambda f: json.dump(coordinate_data, f))
+        stale = columnarPath(name)
+    # A leftover copy in the other format is outdated and the log is part of the document now
+    for path in (stale, oplogPath(name)):
+        if os.path.exists(path):
+            os.remove(path)
+    document_cache.invalidate(name)
+
+
+def documentStamp(name):
+    """Returns the version stamp of a document, which changes whenever one of its files does"""
+    stamp = []
+    for path in (jsonPath(name), columnarPath(name), oplogPath(name)):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+            continue
+        # Replaced files have a new inode, appended ones a new size
+        stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
+def getCoordinateData(name, copy=True):
+    """
+    Returns the coordinate document of a file, from the document cache if it is unchanged.
+    Callers which do not modify the document can pass copy=False to get the cached one.
+    """
+    _, data = readDocument(name)
+    return copyDocument(data) if copy else data
+
+
+def readDocument(name):
+    """Returns the version stamp of a document and the cached document of that version"""
+    stamp = documentStamp(name)
+    data = document_cache.get(name, stamp)
+    if data is None:
+        with fileLock(name, exclusive=False):
+            stamp = documentStamp(name)
+            data = loadCoordinateData(name)
+        document_cache.put(name, stamp, data, documentSize(data))
+    return stamp, data
+
+
+def updateCoordinateData(name, makeOperation, copy=True, retries=UPDATE_RETRIES):
+    """
+    Read-modify-write of a document. makeOperation is called with the document and
+    returns the operation to log or None. The operation is only logged if the document
+    is still the version it was made from, otherwise it is made again from the new one.
+    The last try holds the lock from reading to writing. Returns the logged operation.
+    Pass copy=False if makeOperation does not modify the document.
+    """
+    for _ in range(retries - 1):
+        stamp, data = readDocument(name)
+        op = makeOperation(copyDocument(data) if copy else data)
+        if op is None:
+            return None
+        with fileLock(name):
+            if documentStamp(name) == stamp:
+                logOperation(name, op)
+                return op
+
+    with fileLock(name):
+        op = makeOperation(loadCoordinateData(name))
+        if op is not None:
+            logOperation(name, op)
+        return op
+
+
+def loadCoordinateData(name):
+    """Reads a document from its files, callers hold the lock"""
+    if os.path.exists(columnarPath(name)):
+        data = readColumnar(columnarPath(name))
+    else:
+        with open(jsonPath(name), "r") as f:
+            data = json.load(f)
+    for op in readOperations(name):
+        applyOperation(data, op)
+    return data
+
+
+def readOperations(name):
+    try:
+        with open(oplogPath(name), "r") as f:
+            # A line without its newline is still being written
+            return [json.loads(line) for line in f if line.endswith("\n")]
+    except FileNotFoundError:
+        return []
+
+
+def logOperation(name, op):
+    """
+    Appends an operation to the log of a file, callers hold the lock.
+    The log is compacted into the document once it grows beyond OPLOG_COMPACT_BYTES.
+    """
+    with open(oplogPath(name), "a") as f:
+        f.write(json.dumps(op) + "\n")
+    document_cache.invalidate(name)
+    if os.path.getsize(oplogPath(name)) > OPLOG_COMPACT_BYTES:
+        writeDocument(name, loadCoordinateData(name))
 
 
-def getCoordinateData(name):
-    with open(JSON_FILE_LOCATION + name + ".json", "r") as f:
-        return json.load(f)
+def getLineColumns(name, line_name):
+    """
+    Returns easting, northing, dist and alt of one line as arrays.
+    Columnar files are memory-mapped, so no other line is read.
+    """
+    with fileLock(name, exclusive=False):
+        # Once mapped, a replaced file stays readable as it was
+        if os.path.exists(columnarPath(name)) and not any(
+            op["op"] == "break" for op in readOperations(name)
+        ):
+            return readLineColumns(columnarPath(name), line_name)
+    line = getCoordinateData(name, copy=False)["coords"][line_name]
+    return {
+        column: np.array(
+            [np.nan if p.get(column) is None else p[column] for p in line], dtype=float
+        )
+        for column in COLUMNS
+    }
 
 
 def deleteCoordinateData(name):
-    os.remove(JSON_FILE_LOCATION + name + ".json")
+    with fileLock(name):
+        for path in (jsonPath(name), columnarPath(name), oplogPath(name)):
+            if os.path.exists(path):
+                os.remove(path)
+        document_cache.invalidate(name)
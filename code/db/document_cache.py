@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+# Bounds the memory of the cached documents of every process, as estimated by documentSize
+DOCUMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Memory of a parsed point dictionary with its values, measured with CPython 3.11.
+# Parsed documents take about three times the size of their JSON file.
+POINT_BYTES = 300
+
+
+class DocumentCache:
+    """
+    Least recently used cache of parsed coordinate documents, keyed by File.fname.
+    Every entry remembers the version stamp of the files it was read from and is only
+    returned for the same stamp.
+    """
+
+    def __init__(self, max_bytes=DOCUMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, stamp):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, name, stamp, data, size):
+        with self.lock:
+            self._remove(name)
+            if size > self.max_bytes:
+                return
+            self.entries[name] = (stamp, data, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def documentSize(data):
+    """Estimates the memory of a parsed coordinate document from its number of points"""
+    return POINT_BYTES * sum(
+        len(items) for lines in data.values() for items in lines.values()
+    )
+
+
+def copyDocument(data):
+    """
+    Copies a coordinate document down to its point dictionaries,
+    the values of which are immutable, so the copy shares no mutable state
+    """
+    return {
+        section: {key: [dict(p) for p in items] for key, items in lines.items()}
+        for section, lines in data.items()
+    }
+
+
+document_cache = DocumentCache()
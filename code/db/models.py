@@ -1,4 +1,5 @@
 from db.database import db
+from flask import g, has_request_context
 from flask_login import UserMixin
 import datetime
 
@@ -16,8 +17,10 @@ class File(db.Model):
     title = db.Column(db.String(100))
     fname = db.Column(db.String(100), unique=True)
     date_uploaded = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    uploaded_by_userid = db.Column(db.Integer, db.ForeignKey("user.id"))
+    uploaded_by_userid = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     uploaded_by = db.relationship("User", backref=db.backref("files", lazy=True))
+    # Stage of the upload job, see jobs.py. Rows from before jobs existed have None
+    status = db.Column(db.String(20), default="done")
 
 
 class Suggestion(db.Model):
@@ -26,5 +29,33 @@ class Suggestion(db.Model):
     text = db.Column(db.String(10_000))
     suggestion_type = db.Column(db.String(20))
     date_added = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    uploaded_by_userid = db.Column(db.Integer, db.ForeignKey("user.id"))
+    uploaded_by_userid = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     uploaded_by = db.relationship("User", backref=db.backref("suggestions", lazy=True))
+
+
+def cachedGet(model, ident):
+    """
+    Returns the row of model with the primary key ident or None.
+    Within a request every row is looked up once, later calls return the same object.
+    """
+    try:
+        ident = int(ident)
+    except (TypeError, ValueError):
+        return None
+    if not has_request_context():
+        return db.session.get(model, ident)
+
+    if "identity_cache" not in g:
+        g.identity_cache = {}
+    key = (model.__name__, ident)
+    if key not in g.identity_cache:
+        g.identity_cache[key] = db.session.get(model, ident)
+    return g.identity_cache[key]
+
+
+def getFile(file_id):
+    return cachedGet(File, file_id)
+
+
+def getUser(user_id):
+    return cachedGet(User, user_id)
@@ -0,0 +1,54 @@
+"""
+Operations are small edits of a coordinate document which are appended to a log
+instead of rewriting the whole document. Every operation is a dictionary with an
+"op" key:
+- rename: {"line", "names": {poi index: name}}
+- display: {"line", "display": {poi index: bool}}
+- break: {"line", "index", "point", "names": [first, second], "poi", "markers"}
+  splits the line at index, after inserting point there if it is not None.
+  poi and markers hold the entries of the two new lines.
+"""
+
+
+def applyOperation(data, op):
+    if op["op"] == "rename":
+        poi = data["poi"][op["line"]]
+        for index, name in op["names"].items():
+            poi[int(index)]["name"] = name
+    elif op["op"] == "display":
+        poi = data["poi"][op["line"]]
+        for index, display in op["display"].items():
+            poi[int(index)]["display"] = display
+    elif op["op"] == "break":
+        splitCoords(data, op)
+        data["poi"].update(op["poi"])
+        data["markers"].update(op["markers"])
+    else:
+        raise ValueError(f"Unknown operation {op['op']}")
+
+
+def splitCoords(data, op):
+    """
+    Replaces the line of a break operation by its two halves and removes its poi and markers.
+    The second half starts with a copy of the break point and its dist starts at 0.
+    """
+    line = data["coords"].pop(op["line"])
+    data["poi"].pop(op["line"], None)
+    data["markers"].pop(op["line"], None)
+
+    index = op["index"]
+    if op.get("point") is not None:
+        line.insert(index, dict(op["point"]))
+    breakDistance = line[index]["dist"]
+
+    first = line[: index + 1]
+    second = line[index + 1 :]
+    second.insert(0, line[index].copy())
+    for p in second:
+        p["dist"] -= breakDistance
+    first[-1]["relative"] = "End"
+    second[0]["relative"] = "Start"
+
+    name_1, name_2 = op["names"]
+    data["coords"][name_1] = first
+    data["coords"][name_2] = second
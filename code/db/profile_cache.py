@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Without advisory locks, counts flushed by processes at the same time may be lost
+    fcntl = None
+
+PROFILE_CACHE_LOCATION = "db/profile_cache/"
+PROFILE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Eviction frees this much more than needed, so it does not scan the cache on every put
+PROFILE_CACHE_EVICT_TO = 0.9
+# Other processes write to the cache too, so the size is counted anew after this long
+PROFILE_CACHE_RESCAN_SECONDS = 60
+# Hits and misses of all processes, not a .json file so it is no entry
+COUNTS_NAME = "counts.stats"
+
+
+class ProfileCache:
+    """
+    Content-addressed on-disk cache for elevation profile replies.
+    Entries are keyed by a hash of the LV03 coordinates and the request parameters
+    and evicted least recently used first once the cache grows over max_bytes.
+    Hits and misses are counted in memory and added to a file shared by all
+    processes by flush.
+    """
+
+    def __init__(
+        self, location=PROFILE_CACHE_LOCATION, max_bytes=PROFILE_CACHE_MAX_BYTES
+    ):
+        self.location = location
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Counted since the last flush
+        self.hits = 0
+        self.misses = 0
+        # Size of the entries, counted incrementally after a scan at scanned
+        self.size = None
+        self.scanned = 0
+
+    @staticmethod
+    def makeKey(coords, params):
+        payload = json.dumps(
+            {"coords": [[float(c) for c in p] for p in coords], "params": params},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.location, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        # The modification time doubles as the last access time for eviction
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.location, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.location, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+            size = f.tell()
+        with self.lock:
+            try:
+                replaced = os.path.getsize(self._path(key))
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, self._path(key))
+            if (
+                self.size is None
+                or time.monotonic() - self.scanned > PROFILE_CACHE_RESCAN_SECONDS
+            ):
+                self.scan()
+            else:
+                self.size += size - replaced
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        try:
+            names = os.listdir(self.location)
+        except FileNotFoundError:
+            return []
+        out = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.location, name))
+            except FileNotFoundError:
+                continue
+            out.append((st.st_mtime, st.st_size, name))
+        return out
+
+    def scan(self):
+        self.size = sum(e[1] for e in self.entries())
+        self.scanned = time.monotonic()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is down to
+        PROFILE_CACHE_EVICT_TO of max_bytes, callers hold the lock
+        """
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        entries.sort()
+        for _, entry_size, name in entries:
+            if size <= self.max_bytes * PROFILE_CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(os.path.join(self.location, name))
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
+        self.scanned = time.monotonic()
+
+    def flush(self):
+        """Adds the hits and misses counted since the last flush to the shared counts"""
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+        if not hits and not misses:
+            return
+        os.makedirs(self.location, exist_ok=True)
+        fd = os.open(os.path.join(self.location, COUNTS_NAME), os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            counts = self.parseCounts(f.read())
+            counts["hits"] += hits
+            counts["misses"] += misses
+            f.seek(0)
+            f.truncate()
+            json.dump(counts, f)
+
+    @staticmethod
+    def parseCounts(text):
+        try:
+            counts = json.loads(text)
+            return {"hits": int(counts["hits"]), "misses": int(counts["misses"])}
+        except (ValueError, KeyError, TypeError):
+            return {"hits": 0, "misses": 0}
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.location, COUNTS_NAME), "r") as f:
+                counts = self.parseCounts(f.read())
+        except FileNotFoundError:
+            counts = self.parseCounts("")
+        with self.lock:
+            hits = counts["hits"] + self.hits
+            misses = counts["misses"] + self.misses
+        entries = self.entries()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0,
+            "entries": len(entries),
+            "bytes": sum(e[1] for e in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+profile_cache = ProfileCache()
@@ -0,0 +1,48 @@
+import math
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of at most threshold points of the series (x, y) which keep
+    its visual shape, always including the first and the last point.
+    x and y are only sliced, so memory-mapped arrays are never read as a whole.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = math.floor((i + 1) * every) + 1
+        avg_end = min(math.floor((i + 2) * every) + 1, n)
+        avg_x = np.mean(x[avg_start:avg_end])
+        avg_y = np.mean(y[avg_start:avg_end])
+
+        range_start = math.floor(i * every) + 1
+        range_end = math.floor((i + 1) * every) + 1
+        bucket_x = np.asarray(x[range_start:range_end])
+        bucket_y = np.asarray(y[range_start:range_end])
+        area = np.abs(
+            (x[a] - avg_x) * (bucket_y - y[a]) - (x[a] - bucket_x) * (avg_y - y[a])
+        )
+        a = range_start + int(np.argmax(area))
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+
+def downsampleProfile(dist, alt, threshold, keep_dists=()):
+    """
+    Returns the indices of the profile points to display: the LTTB selection
+    together with the points at keep_dists (POI and markers)
+    """
+    indices = lttb(dist, alt, threshold)
+    if len(keep_dists) and len(dist):
+        keep = np.searchsorted(dist, np.asarray(keep_dists, dtype=float))
+        indices = np.union1d(indices, np.minimum(keep, len(dist) - 1))
+    return indices
@@ -0,0 +1,253 @@
+import json
+import logging
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from db.profile_cache import profile_cache
+
+PROFILE_URL = "https://api3.geo.admin.ch/rest/services/profile.json"
+PROFILE_PARAMS = {"sr": 21781, "distinct_points": "True"}
+
+ELEVATION_PROVIDER = os.environ.get("MZB_ELEVATION_PROVIDER", "geoadmin")
+DTM_LOCATION = os.environ.get("MZB_DTM_LOCATION", "files/dtm/dtm.npy")
+
+PROFILE_WORKERS = 8
+# Longer lines are requested in chunks of this many vertices
+PROFILE_CHUNK_POINTS = 1000
+# Points the profile service resamples every request to, unless asked for others
+PROFILE_NB_POINTS = 200
+
+logger = logging.getLogger(__name__)
+
+
+class ElevationProvider(ABC):
+    """
+    Turns a list of LV03 (easting, northing) pairs into a detailed profile.
+    The profile is a list of point dictionaries with the keys
+    easting, northing, dist and alts (alts["DTM2"] is the altitude in meters).
+    """
+
+    @abstractmethod
+    def profile(self, coords):
+        pass
+
+    def profiles(self, coords_list):
+        """Returns the profiles of several lines, in the order they were given"""
+        return [self.profile(coords) for coords in coords_list]
+
+
+class GeoAdminProfileProvider(ElevationProvider):
+    """Fetches profiles from the geo.admin.ch profile service"""
+
+    def __init__(
+        self,
+        url=PROFILE_URL,
+        params=PROFILE_PARAMS,
+        cache=profile_cache,
+        workers=PROFILE_WORKERS,
+        chunk_points=PROFILE_CHUNK_POINTS,
+        nb_points=PROFILE_NB_POINTS,
+    ):
+        self.url = url
+        self.params = params
+        self.cache = cache
+        self.workers = workers
+        self.chunk_points = chunk_points
+        self.nb_points = nb_points
+        # Seconds taken by the most recent profile requests
+        self.latencies = deque(maxlen=1000)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def profile(self, coords):
+        return self.profiles([coords])[0]
+
+    def fetch(self, coords, params=None):
+        params = params or self.params
+        key = self.cache.makeKey(coords, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        arg = {"type": "LineString", "coordinates": coords}
+        start = time.perf_counter()
+        response = self.session.post(self.url, params=params, json=arg, timeout=3)
+        elapsed = time.perf_counter() - start
+        self.latencies.append(elapsed)
+        logger.info("Profile request for %d points took %.3fs", len(coords), elapsed)
+        response.raise_for_status()
+        profile = response.json()
+        self.cache.put(key, profile)
+        return profile
+
+    def chunk(self, coords):
+        """
+        Splits a line into chunks of at most chunk_points vertices.
+        Neighbouring chunks share their joint vertex.
+        """
+        step = self.chunk_points - 1
+        if len(coords) <= self.chunk_points:
+            return [coords]
+        return [coords[i : i + step + 1] for i in range(0, len(coords) - 1, step)]
+
+    def chunkParams(self, chunks):
+        """
+        Returns the request parameters of the chunks of a line. The service resamples
+        every request to nb_points points, so each chunk asks for its share of them
+        by length, which keeps the density of a single request for the whole line.
+        """
+        if len(chunks) == 1:
+            return [self.params]
+        lengths = [
+            np.hypot(*np.diff(np.asarray(c, dtype=float), axis=0).T).sum()
+            for c in chunks
+        ]
+        total = sum(lengths) or 1
+        return [
+            dict(self.params, nb_points=max(2, math.ceil(self.nb_points * l / total)))
+            for l in lengths
+        ]
+
+    @staticmethod
+    def stitch(chunks):
+        """
+        Joins the profiles of consecutive chunks into one profile,
+        offsetting dist and dropping the duplicated joint points
+        """
+        out = list(chunks[0])
+        for chunk in chunks[1:]:
+            offset = out[-1]["dist"] if out else 0
+            for p in chunk[1:] if out else chunk:
+                p["dist"] += offset
+                out.append(p)
+        return out
+
+    def profiles(self, coords_list):
+        chunks = [self.chunk(coords) for coords in coords_list]
+        tasks = [c for line in chunks for c in line]
+        params = [p for line in chunks for p in self.chunkParams(line)]
+        try:
+            if len(tasks) <= 1:
+                fetched = [self.fetch(c, p) for c, p in zip(tasks, params)]
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(tasks))
+                ) as ex:
+                    fetched = list(ex.map(self.fetch, tasks, params))
+        finally:
+            # Job processes count hits and misses, the web server shows them
+            self.cache.flush()
+
+        out = []
+        for line in chunks:
+            out.append(self.stitch(fetched[: len(line)]))
+            fetched = fetched[len(line) :]
+        return out
+
+
+class LocalDTMProvider(ElevationProvider):
+    """
+    Samples a local elevation grid stored as a memory-mapped .npy file.
+    A .json file next to it holds origin_east and origin_north (center of the
+    top left cell) and cell_size, all in LV03 meters.
+    """
+
+    def __init__(self, location=DTM_LOCATION, step=None):
+        with open(os.path.splitext(location)[0] + ".json", "r") as f:
+            meta = json.load(f)
+        self.grid = np.load(location, mmap_mode="r")
+        self.origin_east = meta["origin_east"]
+        self.origin_north = meta["origin_north"]
+        self.cell_size = meta["cell_size"]
+        self.step = step or 2 * self.cell_size
+
+    @staticmethod
+    def create(location, grid, origin_east, origin_north, cell_size):
+        np.save(location, np.asarray(grid, dtype=np.float32))
+        with open(os.path.splitext(location)[0] + ".json", "w") as f:
+            json.dump(
+                {
+                    "origin_east": origin_east,
+                    "origin_north": origin_north,
+                    "cell_size": cell_size,
+                },
+                f,
+            )
+
+    def densify(self, coords):
+        points = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if len(points) < 2:
+            return points
+        seg = np.diff(points, axis=0)
+        counts = np.maximum(
+            np.ceil(np.hypot(seg[:, 0], seg[:, 1]) / self.step).astype(int), 1
+        )
+        # For every generated point: the segment it lies on and its fraction along it
+        seg_index = np.repeat(np.arange(len(seg)), counts)
+        starts = np.cumsum(counts) - counts
+        t = (np.arange(counts.sum()) - starts[seg_index]) / counts[seg_index]
+        dense = points[seg_index] + seg[seg_index] * t[:, None]
+        return np.vstack((dense, points[-1:]))
+
+    def sample(self, east, north):
+        col = (east - self.origin_east) / self.cell_size
+        row = (self.origin_north - north) / self.cell_size
+        rows, cols = self.grid.shape
+        if (
+            col.min() < 0
+            or row.min() < 0
+            or col.max() > cols - 1
+            or row.max() > rows - 1
+        ):
+            raise ValueError("Line lies outside of the local elevation model")
+
+        c0 = np.minimum(np.floor(col).astype(int), cols - 2)
+        r0 = np.minimum(np.floor(row).astype(int), rows - 2)
+        fc = col - c0
+        fr = row - r0
+        top = self.grid[r0, c0] * (1 - fc) + self.grid[r0, c0 + 1] * fc
+        bottom = self.grid[r0 + 1, c0] * (1 - fc) + self.grid[r0 + 1, c0 + 1] * fc
+        return top * (1 - fr) + bottom * fr
+
+    def profile(self, coords):
+        dense = self.densify(coords)
+        east, north = dense[:, 0], dense[:, 1]
+        dist = np.concatenate(
+            ([0.0], np.cumsum(np.hypot(np.diff(east), np.diff(north))))
+        )
+        alt = self.sample(east, north)
+        return [
+            {"dist": d, "alts": {"DTM2": a}, "easting": e, "northing": n}
+            for d, a, e, n in zip(
+                np.round(dist, 1).tolist(),
+                np.round(alt, 1).tolist(),
+                np.round(east, 2).tolist(),
+                np.round(north, 2).tolist(),
+            )
+        ]
+
+
+_provider = None
+
+
+def getElevationProvider():
+    global _provider
+    if _provider is None:
+        if ELEVATION_PROVIDER == "dtm":
+            _provider = LocalDTMProvider()
+        else:
+            _provider = GeoAdminProfileProvider()
+    return _provider
+
+
+def setElevationProvider(provider):
+    global _provider
+    _provider = provider
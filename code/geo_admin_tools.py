@@ -1,143 +1,277 @@
 from functools import reduce
+from collections import deque
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import bisect
 import os
 import math
-import time
-import requests
-from pykml import parser
-from pykml.factory import GX_ElementMaker as GX
-import openpyxl
+import zipfile
+import numpy as np
 from lxml import etree
 from wgs84_ch1903 import GPSConverter
+from elevation import getElevationProvider
+from segment_index import SegmentIndex
+from simplify import rdp, nearPoints
+from utils import getUniqueId
+from kml_writer import iterKML
+from kml_reader import readUpload
+from xlsx_writer import getXlsxTemplate
+from zip_writer import iterZip
+from jobs import DONE, FAILED, readStatus, removeJob
 from db.db_utils import (
+    fileLock,
+    writeDocument,
     saveCoordinateData,
     getCoordinateData,
+    getLineColumns,
     deleteCoordinateData,
+    updateCoordinateData,
 )
+from db.oplog import splitCoords
 from db.database import db
-from db.models import File
+from db.models import File, getFile
 
 KML_FILE_LOCATION = "./files/kml/"
 XLSX_FILE_LOCATION = "./files/xlsx/"
 
 POINT_CLOSE_MARGIN = 50
 
-converter = GPSConverter()
-
+# Uploaded vertices closer than this many meters to the simplified line are dropped,
+# 0 disables the simplification
+SIMPLIFY_TOLERANCE = float(os.environ.get("MZB_SIMPLIFY_TOLERANCE", 2))
 
-def generate_kml(fname, line_name):
-    data = getCoordinateData(fname)
-    coords = data["coords"][line_name]
-    poi = data["poi"][line_name]
+# Workbooks filled at the same time for a bulk export
+EXPORT_WORKERS = 4
 
-    root = getBaseKML()
+logger = logging.getLogger(__name__)
 
-    appendLineToRoot(root, coords, line_name)
-    appendPOIMarkers(root, poi)
-    return etree.tostring(root)
+converter = GPSConverter()
 
 
-def generate_xlsx(fname, line_name):
-    poi = getCoordinateData(fname)["poi"][line_name]
-    book = openpyxl.load_workbook("files/xlsx/base.xlsx")
-    sheet = book["leer"]
+def generate_kml(fname, line_name):
+    """Returns a generator of the KML of a line and its displayed POI in chunks of bytes"""
+    poi = getCoordinateData(fname, copy=False)["poi"][line_name]
+    return iterKML(kmlLines(fname, [line_name]), kmlMarkers(poi))
 
-    for i, p in enumerate(poi):
-        sheet[f"A{i+8}"] = p["name"]
-        sheet[f"C{i+8}"] = p["alt"]
 
-        if i != 0:
-            sheet[f"E{i+8}"] = (p["dist"] - poi[i - 1]["dist"]) / 1000
+def kmlLines(fname, line_names):
+    """Generates the (name, lats, lngs) of the given lines, one line at a time"""
+    for line_name in line_names:
+        columns = getLineColumns(fname, line_name)
+        lat, lng, _ = converter.LV03toWGS84_batch(
+            columns["easting"], columns["northing"], 0
+        )
+        yield line_name, lat.tolist(), lng.tolist()
 
-    return book
 
+def kmlMarkers(poi):
+    """Returns the (title, lat, lng) of the displayed POI"""
+    displayed = [p for p in poi if p["display"]]
+    lat, lng, _ = converter.LV03toWGS84_batch(*coordsToArrays(displayed), 0)
+    return list(zip([p["name"] for p in displayed], lat.tolist(), lng.tolist()))
 
-def combineAndSave(file, filename):
-    data = createDataFromFile(file)
-    saveCoordinateData(filename, data)
 
+def generate_xlsx(fname, line_name):
+    """Returns the bytes of the time calculation workbook of a line"""
+    poi = getCoordinateData(fname, copy=False)["poi"][line_name]
+    return getXlsxTemplate().fill(xlsxCells(poi))
 
-def createDataFromFile(file):
-    root = parser.parse(file).getroot()
-    coords = rootToDetailedCoords(root)
 
-    changed = True
-    while changed:
-        changed = combineLines(coords)
+def generate_zip(fname, title, combined=False):
+    """
+    Generates a ZIP archive with the KML and the workbook of every line in chunks of bytes.
+    The document is read once and the workbooks are filled in parallel while the KML
+    is written, at most EXPORT_WORKERS of them ahead of the line being written.
+    With combined, one KML of all lines and one workbook with a sheet per line are added.
+    """
+    poi = getCoordinateData(fname, copy=False)["poi"]
+    names = list(poi)
+    template = getXlsxTemplate()
+    base = title.replace("/", "_").replace("\\", "_")
+
+    def fill(name):
+        return template.fill(xlsxCells(poi[name]))
+
+    def entries(executor):
+        # Only a few workbooks are kept in memory, the next is filled as one is written
+        workbooks = deque(
+            executor.submit(fill, name) for name in names[:EXPORT_WORKERS]
+        )
+        if combined:
+            sheets = executor.submit(
+                template.fillSheets,
+                [(sheetTitle(name, poi[name]), xlsxCells(poi[name])) for name in names],
+            )
+        for i, name in enumerate(names):
+            kml = iterKML(kmlLines(fname, [name]), kmlMarkers(poi[name]))
+            yield f"{base}_{name}.kml", kml, zipfile.ZIP_DEFLATED
+            workbook = workbooks.popleft().result()
+            if i + EXPORT_WORKERS < len(names):
+                workbooks.append(executor.submit(fill, names[i + EXPORT_WORKERS]))
+            yield f"{base}_{name}.xlsx", [workbook], zipfile.ZIP_STORED
+        if combined:
+            markers = [m for name in names for m in kmlMarkers(poi[name])]
+            kml = iterKML(kmlLines(fname, names), markers)
+            yield f"{base}.kml", kml, zipfile.ZIP_DEFLATED
+            yield f"{base}.xlsx", [sheets.result()], zipfile.ZIP_STORED
+
+    executor = ThreadPoolExecutor(EXPORT_WORKERS)
+    try:
+        yield from iterZip(entries(executor))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def sheetTitle(line_name, poi):
+    if not poi:
+        return line_name
+    return f"{poi[0]['name']} - {poi[-1]['name']}"
+
+
+def xlsxCells(poi):
+    cells = {}
+    for i, p in enumerate(poi):
+        cells[f"A{i+8}"] = p["name"]
+        cells[f"C{i+8}"] = p["alt"]
 
-    markers = getSuppliedMarkers(root, coords)
+        if i != 0:
+            cells[f"E{i+8}"] = (p["dist"] - poi[i - 1]["dist"]) / 1000
+    return cells
+
+
+def combineAndSave(file, filename, progress=None):
+    """Returns False if the File of filename was deleted meanwhile, nothing is saved then"""
+    progress = progress or noProgress
+    data = createDataFromFile(file, progress)
+    progress("saving")
+    # removeRecord deletes the row before the data, under the same lock
+    with fileLock(filename):
+        if File.query.filter_by(fname=filename).first() is None:
+            return False
+        writeDocument(filename, data)
+    return True
+
+
+def noProgress(stage):
+    pass
+
+
+def createDataFromFile(file, progress=None):
+    """progress is called with the name of every stage of jobs.STAGES as it starts"""
+    progress = progress or noProgress
+    progress("parsing")
+    lines, supplied = readUpload(file)
+    progress("profiles")
+    detailed = rootToDetailedCoords(lines, suppliedMarkerCoords(supplied))
+    progress("combining")
+    coords = chainLines(detailed)
+
+    progress("markers")
+    markers = getSuppliedMarkers(supplied, coords)
+    progress("poi")
     poi = generatePOI(
         coords, markers
     )  # POI Are named with available markers or relative position
     return {"coords": coords, "poi": poi, "markers": markers}
 
 
-def combineLines(coords):
-    for key, value in coords.items():
-        for k, v in coords.items():
-            if key == k:
-                continue
-            if pointEquals(value[0], v[-1]):
-                for c in value:
-                    c["dist"] += v[-1]["dist"]
-                combinedLine = v[:] + value[1:]
-                del coords[key]
-                del coords[k]
-                coords[f"measure_generated_{getCurrentTimeString()}"] = combinedLine
+def chainLines(coords):
+    """
+    Joins lines whose end point is the start point of another line into one line.
+    The chains are found in a single pass over an index of the line start points,
+    lines which are not part of a chain keep their name.
+    """
+    starts = {}
+    for key, line in coords.items():
+        starts.setdefault(pointKey(line[0]), []).append(key)
+
+    successors = {}
+    has_predecessor = set()
+    for key, line in coords.items():
+        for k in starts.get(pointKey(line[-1]), []):
+            if k != key and k not in has_predecessor:
+                successors[key] = k
+                has_predecessor.add(k)
+                break
+
+    single = {}
+    combined = {}
+    visited = set()
+    # Closed loops have no line without a predecessor, they start at their first line
+    heads = [k for k in coords if k not in has_predecessor] + list(coords)
+    for head in heads:
+        if head in visited:
+            continue
+        chain = []
+        key = head
+        while key is not None and key not in visited:
+            visited.add(key)
+            chain.append(coords[key])
+            key = successors.get(key)
+
+        if len(chain) == 1:
+            single[head] = chain[0]
+        else:
+            combined[f"measure_generated_{getUniqueId()}"] = joinChain(chain)
+
+    return {**single, **combined}
+
 
-                return True
+def joinChain(chain):
+    line = chain[0][:]
+    for part in chain[1:]:
+        offset = line[-1]["dist"]
+        for p in part:
+            p["dist"] += offset
+        line.extend(part[1:])
+    return line
 
-            if pointEquals(value[-1], v[0]):
-                for c in v:
-                    c["dist"] += value[-1]["dist"]
-                combinedLine = value[:] + v[1:]
-                del coords[key]
-                del coords[k]
-                coords[f"measure_generated_{getCurrentTimeString()}"] = combinedLine
 
-                return True
-    return False
+def pointKey(p):
+    return (p["easting"], p["northing"])
 
 
 def pointEquals(p1, p2):
     return p1["easting"] == p2["easting"] and p1["northing"] == p2["northing"]
 
 
-def rootToDetailedCoords(root):
-    pms = list(
-        filter(
-            lambda x: x.get("id")
-            and ("measure" in x.get("id") or "linepolygon" in x.get("id")),
-            root.Document.getchildren(),
+def rootToDetailedCoords(lines, markers=None):
+    """
+    lines maps the ids of the uploaded lines to arrays of longitude and latitude,
+    markers are the eastings and northings of the supplied markers.
+    Lines are simplified before their profiles are requested, keeping the vertices
+    near markers so they are placed the same.
+    """
+    lv03 = {}
+    for pm_id, coords in lines.items():
+        east, north, _ = converter.WGS84toLV03_batch(
+            coords[:, 1], coords[:, 0], 0, clip=True
         )
-    )
+        if SIMPLIFY_TOLERANCE > 0:
+            keep = None
+            if markers is not None:
+                keep = nearPoints(east, north, *markers, POINT_CLOSE_MARGIN)
+            mask = rdp(east, north, SIMPLIFY_TOLERANCE, keep)
+            logger.info(
+                "Simplified %s from %d to %d vertices", pm_id, len(east), mask.sum()
+            )
+            east, north = east[mask], north[mask]
+        lv03[pm_id] = np.column_stack((east, north)).tolist()
 
     data = {}
-    for pm in pms:
-        pm_id = pm.get("id")
-        data[pm_id] = []
-        coords = parseLineString(pm)
-        for i, coord in enumerate(coords):
-            data[pm_id].append(
-                converter.WGS84toLV03(coord[0], coord[1], 0, clip=True)[0:2]
-            )
-        data[pm_id] = getDetailedCoords(data[pm_id])
-        getRightAlts(data[pm_id])
+    for pm_id, profile in zip(lv03.keys(), getDetailedCoordsMany(list(lv03.values()))):
+        getRightAlts(profile)
+        data[pm_id] = profile
     return data
 
 
-def appendLineToRoot(root, coords, name):
-    line = [converter.LV03toWGS84(p["easting"], p["northing"], 0)[0:2] for p in coords]
-    root.Document.append(createLine(name, line))
-
-
-def appendPOIMarkers(root, poi):
-    poi_conv = [
-        converter.LV03toWGS84(p["easting"], p["northing"], 0)[0:2] + (p["name"],)
-        for p in poi
-        if p["display"]
-    ]
-    for i, p in enumerate(poi_conv):
-        root.Document.append(create_marker(i, p[2], p[1], p[0]))
+def coordsToArrays(coords):
+    """
+    Returns the eastings and northings of a list of point dictionaries as two arrays
+    """
+    east = np.fromiter((p["easting"] for p in coords), dtype=float, count=len(coords))
+    north = np.fromiter((p["northing"] for p in coords), dtype=float, count=len(coords))
+    return east, north
 
 
 def saveKML(root, filename, data):
@@ -147,11 +281,6 @@ def saveKML(root, filename, data):
     # New Excel files should be generated
 
 
-def getBaseKML():
-    with open("files/kml/base.kml", "rb") as f:
-        return parser.parse(f).getroot()
-
-
 def removeGenerated(root):
     els = root.Document
 
@@ -161,91 +290,8 @@ def removeGenerated(root):
     return root
 
 
-def create_marker(index, title, east, north):
-    marker = parser.fromstring(
-        f"""<Placemark id="marker_{index}_generated">
-  <ExtendedData>
-    <Data name="type">
-      <value>marker</value>
-    </Data>
-  </ExtendedData>
-  <name>{title}</name>
-  <description></description>
-  <Style>
-    <IconStyle>
-      <Icon>
-        <href>https://api3.geo.admin.ch/color/255,0,0/marker-24@2x.png</href>
-      </Icon>
-      <hotSpot x="24" y="4.799999999999997" xunits="pixels" yunits="pixels"/>
-    </IconStyle>
-    <LabelStyle>
-      <color>ff0000ff</color>
-    </LabelStyle>
-  </Style>
-  <Point>
-    <tessellate>1</tessellate>
-    <altitudeMode>clampToGround</altitudeMode>
-    <coordinates>{east},{north}</coordinates>
-  </Point>
-</Placemark>"""
-    )
-    icon = marker.Style.IconStyle.Icon
-    icon.append(GX.w(48))
-    icon.append(GX.h(48))
-
-    return marker
-
-
-def createLine(id: str, coordinates: list[list[float]]):
-    coordinate_string = ""
-
-    for i, c in enumerate(coordinates):
-        coordinate_string += f"{str(c[1])},{str(c[0])}"
-        if i != len(coordinates) - 1:
-            coordinate_string += " "
-
-    placemark_string = f"""
-    <Placemark id="{id}">
-      <ExtendedData>
-        <Data name="overlays"/>
-        <Data name="type">
-          <value>measure</value>
-        </Data>
-      </ExtendedData>
-      <Style>
-        <LineStyle>
-          <color>ff0000ff</color>
-          <width>3</width>
-        </LineStyle>
-        <PolyStyle>
-          <color>660000ff</color>
-        </PolyStyle>
-      </Style>
-      <LineString>
-        <tessellate>1</tessellate>
-        <altitudeMode>clampToGround</altitudeMode>
-        <coordinates>{coordinate_string}</coordinates>
-      </LineString>
-    </Placemark>"""
-
-    return parser.fromstring(placemark_string)
-
-
-def parseLineString(placemark):
-    return [
-        (float(xy.split(",")[1]), float(xy.split(",")[0]))
-        for xy in placemark.LineString.coordinates.text.split(" ")
-    ]
-
-
-def getDetailedCoords(coords):
-    arg = {"type": "LineString", "coordinates": coords}
-    print("Making an API request")
-    return requests.post(
-        "https://api3.geo.admin.ch/rest/services/profile.json?sr=21781&distinct_points=True",
-        json=arg,
-        timeout=3,
-    ).json()
+def getDetailedCoordsMany(coords_list):
+    return getElevationProvider().profiles(coords_list)
 
 
 def getRightAlts(coords):
@@ -254,50 +300,29 @@ def getRightAlts(coords):
         del p["alts"]
 
 
-def generatePOI(coords, markers):
+def generatePOI(coords, markers, margins=None):
+    """
+    Returns the POI of every line: start, end, supplied markers and the most prominent highs and lows.
+    If a margins dictionary is given, the altitude margin chosen for every line is stored in it.
+    """
     out = {}
-    for key, item_ in coords.items():
-        item = item_.copy()
-        for i, c in enumerate(item):
-            c["relative"] = (
-                "Start"
-                if i == 0
-                else "End"
-                if i == len(item) - 1
-                else "High"
-                if (item[i - 1]["alt"] < c["alt"] and c["alt"] > item[i + 1]["alt"])
-                else "Low"
-                if (item[i - 1]["alt"] > c["alt"] and c["alt"] < item[i + 1]["alt"])
-                else None
-            )
-
-        poi_tmp = [c for c in item if c["relative"]]
-        poi = []
-        MAX_ITEMS = 19 - len(markers[key])
-        over = True
-        margin = 0
-        while over:
-            over = False
-
-            for i in range(1, len(poi_tmp) - 1):
-                if (
-                    max(
-                        abs(poi_tmp[i]["alt"] - poi_tmp[i - 1]["alt"]),
-                        abs(poi_tmp[i]["alt"] - poi_tmp[i + 1]["alt"]),
-                    )
-                    >= margin
-                ):
-                    poi.append(poi_tmp[i])
-
-            if len(poi) > MAX_ITEMS:
-                over = True
-                margin += 5
-                poi = []
+    for key, item in coords.items():
+        alts = np.fromiter((c["alt"] for c in item), dtype=float, count=len(item))
+        relative = relativeExtrema(alts)
+        for c, r in zip(item, relative):
+            c["relative"] = r
+
+        extrema = [i for i, r in enumerate(relative) if r]
+        poi_tmp = [item[i] for i in extrema]
+        chosen, margin = selectByProminence(alts[extrema], 19 - len(markers[key]))
+        poi = [poi_tmp[i] for i in chosen]
+        if margins is not None:
+            margins[key] = margin
 
         insertMarkersToPOI(poi, poi_tmp[0], poi_tmp[-1], markers[key])
 
         for i, p in enumerate(poi):
-            p["id"] = f"marker_{getCurrentTimeString()}"
+            p["id"] = f"marker_{getUniqueId()}"
             if "name" not in p.keys():
                 p["name"] = p["relative"]
             if p["relative"] == "Marker" or i == 0 or i == len(poi) - 1:
@@ -308,6 +333,41 @@ def generatePOI(coords, markers):
     return out
 
 
+def relativeExtrema(alts):
+    """Returns "Start", "End", "High", "Low" or None for every altitude of a profile"""
+    inner = alts[1:-1]
+    relative = np.full(len(alts), None, dtype=object)
+    relative[1:-1][(alts[:-2] < inner) & (inner > alts[2:])] = "High"
+    relative[1:-1][(alts[:-2] > inner) & (inner < alts[2:])] = "Low"
+    if len(alts):
+        relative[-1] = "End"
+        relative[0] = "Start"
+    return relative.tolist()
+
+
+def selectByProminence(alts, max_items):
+    """
+    Takes the altitudes of the start, the extrema and the end of a line.
+    Returns the indices of the extrema whose altitude differs by at least margin from
+    one of their neighbours, where margin is the smallest multiple of 5 m that leaves
+    at most max_items of them, and the margin.
+    """
+    if len(alts) < 3:
+        return np.empty(0, dtype=int), 0
+
+    inner = alts[1:-1]
+    scores = np.maximum(np.abs(inner - alts[:-2]), np.abs(inner - alts[2:]))
+    max_items = max(max_items, 0)
+
+    margin = 0
+    if len(scores) > max_items:
+        # The margin has to exceed the score of the first extremum which may not be kept
+        limit = np.partition(scores, -(max_items + 1))[-(max_items + 1)]
+        margin = 5 * (math.floor(limit / 5) + 1)
+
+    return (np.nonzero(scores >= margin)[0] + 1).tolist(), margin
+
+
 def insertMarkersToPOI(poi, start, end, markers):
     poi.insert(0, start)
     poi.append(end)
@@ -323,26 +383,27 @@ def insertMarkersToPOI(poi, start, end, markers):
                 break
 
 
-def getSuppliedMarkers(root, coords):
-    markersRaw = list(
-        filter(
-            lambda x: x.get("id") and "marker" in x.get("id"),
-            root.Document.getchildren(),
-        )
-    )
-    markersTexts = [p.Point.coordinates.text.split(",") for p in markersRaw]
-    markersCoords = [
-        converter.WGS84toLV03(float(p[1]), float(p[0]), 0)[0:2] for p in markersTexts
-    ]
-    markersTitles = [p.name.text for p in markersRaw]
+def getSuppliedMarkers(supplied, coords):
+    """supplied is a list of the (title, longitude, latitude) of the uploaded markers"""
+    east, north = suppliedMarkerCoords(supplied)
+    markersCoords = list(zip(east.tolist(), north.tolist()))
+    markersTitles = [m[0] for m in supplied]
 
     return sortMarkersByLine(coords, markersCoords, markersTitles)
 
 
+def suppliedMarkerCoords(supplied):
+    """Returns the eastings and northings of the uploaded markers as two arrays"""
+    markersTexts = np.array([m[1:] for m in supplied], dtype=float).reshape(-1, 2)
+    east, north, _ = converter.WGS84toLV03_batch(
+        markersTexts[:, 1], markersTexts[:, 0], 0
+    )
+    return east, north
+
+
 def resortMarkersByLine(
-    breakIndex: int, markers: list[dict]
+    breakIndex: int, breakDistance: float, markers: list[dict]
 ) -> tuple[list[dict], list[dict]]:
-    breakDistance = list(filter(lambda x: x["index"] == breakIndex, markers))[0]["dist"]
     markers_1 = []
     markers_2 = []
     for m in markers:
@@ -362,31 +423,24 @@ def sortMarkersByLine(coords, markersCoords, markersTitles=None):
     out = {}
 
     for key, value in coords.items():
-        out[key] = []
+        index = SegmentIndex(*coordsToArrays(value), POINT_CLOSE_MARGIN)
+        snapped = []
         for i, p in enumerate(markersCoords):
-            point, dist, index = closestPointOnCoords(
+            point, dist, end = closestPointOnCoords(
                 value,
                 {"easting": p[0], "northing": p[1]} if isinstance(p, tuple) else p,
+                index,
             )
+            if point is None:
+                continue
+
             if markersTitles:
                 point["name"] = markersTitles[i]
             else:
                 point["name"] = p["name"]
+            snapped.append((end, point))
 
-            if dist > POINT_CLOSE_MARGIN:
-                continue
-
-            if pointEquals(point, value[index - 1]):
-                point["index"] = index - 1
-                value[index - 1] = point
-            else:
-                point["index"] = index
-                if pointEquals(point, value[index]):
-                    value[index] = point
-                else:
-                    value.insert(index, point)
-
-            out[key].append(point.copy())
+        out[key] = [m.copy() for m in placeMarkersOnLine(value, snapped)]
 
     for key, value in out.items():
         value.sort(key=lambda x: x["dist"])
@@ -394,40 +448,134 @@ def sortMarkersByLine(coords, markersCoords, markersTitles=None):
     return out
 
 
+def placeMarkersOnLine(line, snapped):
+    """
+    Puts snapped markers into the line in place, either replacing the vertex they lie on
+    or inserted between the two vertices of their segment.
+    Sets the index of every marker to its final position in the line.
+    """
+    replaced = {}
+    inserted = {}
+    slots = []
+    for end, point in snapped:
+        if pointEquals(point, line[end - 1]):
+            replaced[end - 1] = point
+            slots.append(("vertex", end - 1))
+        elif pointEquals(point, line[end]):
+            replaced[end] = point
+            slots.append(("vertex", end))
+        else:
+            inserted.setdefault(end, []).append(point)
+            slots.append(("inserted", id(point)))
+
+    new_line = []
+    positions = {}
+    for i, p in enumerate(line):
+        for m in sorted(inserted.get(i, []), key=lambda x: x["dist"]):
+            if new_line and pointEquals(new_line[-1], m):
+                new_line[-1] = m
+            else:
+                new_line.append(m)
+            positions[("inserted", id(m))] = len(new_line) - 1
+        new_line.append(replaced.get(i, p))
+        positions[("vertex", i)] = len(new_line) - 1
+
+    for (_, point), slot in zip(snapped, slots):
+        point["index"] = positions[slot]
+    line[:] = new_line
+    return [point for _, point in snapped]
+
+
 def pointsClose(p1, p2):
     dist = (p1["easting"] - p2["easting"]) ** 2 + (p1["northing"] - p2["northing"]) ** 2
     return dist <= POINT_CLOSE_MARGIN
 
 
 def breakLineAtPoint(fname, line_name, point):
-    data = getCoordinateData(fname)
-    markers = data["markers"][line_name]
-    if point not in [x["id"] for x in markers]:
-        return False
-    marker = list(filter(lambda x: x["id"] == point, markers))[0]
-    index = marker["index"]
-    line = data["coords"][line_name][:]
-
-    del data["coords"][line_name]
-    del data["poi"][line_name]
-    del data["markers"][line_name]
-
-    new_name_1 = f"measure_generated_{getCurrentTimeString()}"
-    data["coords"][new_name_1] = line[: index + 1]
+    def makeBreak(data):
+        if line_name not in data["coords"]:
+            return None
+        marker = next((x for x in data["markers"][line_name] if x["id"] == point), None)
+        if marker is None:
+            return None
+        return splitLine(data, line_name, marker["index"])
+
+    return updateCoordinateData(fname, makeBreak) is not None
+
+
+def breakLineAtDistance(fname, line_name, dist):
+    def makeBreak(data):
+        if line_name not in data["coords"]:
+            return None
+        line = data["coords"][line_name]
+        index, point = pointAtDistance(line, dist)
+        if index is None or point is line[0] or point is line[-1]:
+            return None
+        return splitLine(
+            data, line_name, index, None if point is line[index] else point
+        )
 
-    new_name_2 = f"measure_generated_{getCurrentTimeString()}"
-    data["coords"][new_name_2] = line[index + 1 :]
-    data["coords"][new_name_2].insert(0, line[index].copy())
+    return updateCoordinateData(fname, makeBreak) is not None
 
-    firstDist = data["coords"][new_name_2][0]["dist"]
-    for p in data["coords"][new_name_2]:
-        p["dist"] -= firstDist
 
-    data["markers"][new_name_1], data["markers"][new_name_2] = resortMarkersByLine(
-        index, markers
+def pointAtDistance(line, dist):
+    """
+    Returns the index of the point at the given distance along the line and the point.
+    If no vertex lies at that distance, the point is interpolated between its neighbours
+    and the index is the position it would be inserted at.
+    Returns (None, None) if the distance is not on the line.
+    """
+    i = bisect.bisect_left(line, dist, key=lambda p: p["dist"])
+    if i < len(line) and line[i]["dist"] == dist:
+        return i, line[i]
+    if i == 0 or i == len(line):
+        return None, None
+
+    begin, end = line[i - 1], line[i]
+    a = (dist - begin["dist"]) / (end["dist"] - begin["dist"])
+    return i, {
+        "easting": begin["easting"] + a * (end["easting"] - begin["easting"]),
+        "northing": begin["northing"] + a * (end["northing"] - begin["northing"]),
+        "dist": dist,
+        "alt": begin["alt"] + a * (end["alt"] - begin["alt"]),
+        "relative": None,
+    }
+
+
+def splitLine(data, line_name, index, point=None):
+    """
+    Splits a line of the coordinate data into two new lines at the point with the given index,
+    after inserting point at that index if it is given.
+    Returns the break operation for the operation log.
+    """
+    markers = data["markers"][line_name]
+    if point is not None:
+        markers = [
+            dict(m, index=m["index"] + 1) if m["index"] >= index else m for m in markers
+        ]
+    breakDistance = (point or data["coords"][line_name][index])["dist"]
+
+    op = {
+        "op": "break",
+        "line": line_name,
+        "index": index,
+        "point": point,
+        "names": [
+            f"measure_generated_{getUniqueId()}",
+            f"measure_generated_{getUniqueId()}",
+        ],
+    }
+    splitCoords(data, op)
+
+    new_markers = dict(
+        zip(op["names"], resortMarkersByLine(index, breakDistance, markers))
     )
-    data["poi"] = generatePOI(data["coords"], data["markers"])
-    saveCoordinateData(fname, data)
+    new_poi = generatePOI({n: data["coords"][n] for n in op["names"]}, new_markers)
+    data["markers"].update(new_markers)
+    data["poi"].update(new_poi)
+    op["markers"] = new_markers
+    op["poi"] = new_poi
+    return op
 
 
 def getPointDistance(px, py, qx, qy):
@@ -435,85 +583,81 @@ def getPointDistance(px, py, qx, qy):
 
 
 def removeRecord(file_id):
-    fname = File.query.get(file_id).fname
+    file = getFile(file_id)
+    fname = file.fname
+    # Deleted first, so a running upload job does not save its data afterwards
+    db.session.delete(file)
+    db.session.commit()
+
     deleteCoordinateData(fname)
+    removeJob(fname)
 
-    db.session.delete(File.query.get(file_id))
-    db.session.commit()
+
+def refreshStatus(file):
+    """
+    Returns the status of the upload job of a file and stores it in its row once
+    the job has finished. The status file of a failed job is kept for its error.
+    """
+    if file.status in (None, DONE, FAILED):
+        job = readStatus(file.fname) if file.status == FAILED else None
+        return {"status": file.status or DONE, "error": job and job["error"]}
+
+    job = readStatus(file.fname) or {"status": FAILED, "error": None}
+    if job["status"] in (DONE, FAILED):
+        file.status = job["status"]
+        db.session.commit()
+        if job["status"] == DONE:
+            removeJob(file.fname)
+    return job
 
 
-def closestPointOnCoords(coords, point):
+def closestPointOnCoords(coords, point, index=None):
     """
     Returns a point dictionary,
     distance to closest point on the line,
     the index of the point which ends the line, the point is closest to (point is between index - 1 and index)
+    Returns (None, inf, None) if the line is farther away than POINT_CLOSE_MARGIN
     """
-    smallestDist = float("inf")
-    linePoint = (0, 0)
-    closestA = 0
-    index = 0
-    for i in range(1, len(coords)):
-        newDist, newPoint, a = closestPointOnLine(coords[i - 1], coords[i], point)
-        if newDist < smallestDist:
-            smallestDist = newDist
-            linePoint = newPoint
-            closestA = a
-            index = i
-
-    dalt = coords[index]["alt"] - coords[index - 1]["alt"]
-    ddist = coords[index]["dist"] - coords[index - 1]["dist"]
+    if index is None:
+        index = SegmentIndex(*coordsToArrays(coords), POINT_CLOSE_MARGIN)
+    nearest = index.nearest(point["easting"], point["northing"], POINT_CLOSE_MARGIN)
+    if nearest is None:
+        return None, float("inf"), None
+    segment, closestA, smallestDist = nearest
+    begin, end = coords[segment], coords[segment + 1]
+
+    if closestA == 0:
+        linePoint = (begin["easting"], begin["northing"])
+    elif closestA == 1:
+        linePoint = (end["easting"], end["northing"])
+    else:
+        linePoint = (
+            begin["easting"] + closestA * (end["easting"] - begin["easting"]),
+            begin["northing"] + closestA * (end["northing"] - begin["northing"]),
+        )
+
+    dalt = end["alt"] - begin["alt"]
+    ddist = end["dist"] - begin["dist"]
 
     return (
         {
             "easting": linePoint[0],
             "northing": linePoint[1],
-            "dist": coords[index - 1]["dist"] + closestA * ddist,
-            "alt": coords[index - 1]["alt"] + closestA * dalt,
+            "dist": begin["dist"] + closestA * ddist,
+            "alt": begin["alt"] + closestA * dalt,
             "relative": "Marker",
         },
         smallestDist,
-        index,
+        segment + 1,
     )
 
 
-def closestPointOnLine(l_begin, l_end, point):
-    x1, y1 = l_begin["easting"], l_begin["northing"]
-    x2, y2 = l_end["easting"], l_end["northing"]
-    x3, y3 = point["easting"], point["northing"]
-
-    dx, dy = x2 - x1, y2 - y1
-    det = dx * dx + dy * dy
-
-    a = (dy * (y3 - y1) + dx * (x3 - x1)) / det
-    b = (dy * (x3 - x1) + dx * (y1 - y3)) / det
-
-    dist = abs(b) * math.sqrt(det)
-
-    if a < 0:
-        a = 0
-        closestPoint = (x1, y1)
-        dist = distBetweenPoints(l_begin, point)
-    elif a > 0:
-        a = 1
-        closestPoint = (x2, y2)
-        dist = distBetweenPoints(l_end, point)
-    else:
-        closestPoint = (x1 + a * dx, y1 + a * dy)
-
-    return (dist, closestPoint, a)
-
-
 def distBetweenPoints(p1, p2):
     return math.sqrt(
         (p1["easting"] - p2["easting"]) ** 2 + (p1["northing"] - p2["northing"]) ** 2
     )
 
 
-def getCurrentTimeString():
-    time.sleep(0.002)
-    return str(round(time.time() * 1000))
-
-
 def getCenterCoords(coords):
     out = {}
     for key, value in coords.items():
@@ -534,28 +678,40 @@ def getCenterCoords(coords):
 
 def updatePoiNames(form):
     file_id = form["file_id"]
-    fname = File.query.get(file_id).fname
+    fname = getFile(file_id).fname
     line_segment = form["linesegment"]
 
-    data = getCoordinateData(fname)
+    def makeRename(data):
+        # The line may have been broken up in the meantime
+        poi = data["poi"].get(line_segment)
+        if poi is None:
+            return None
+        names = {}
+        for key, name in form.items():
+            if key.startswith("name"):
+                index = int(key.split("_")[1]) - 1
+                if poi[index]["name"] != name:
+                    names[index] = name
+        if names:
+            return {"op": "rename", "line": line_segment, "names": names}
 
-    for key, name in form.items():
-        if key.startswith("name"):
-            index = int(key.split("_")[1]) - 1
-            data["poi"][line_segment][index]["name"] = name
-    saveCoordinateData(fname, data)
+    updateCoordinateData(fname, makeRename, copy=False)
 
 
 def updatePoiDisplay(form):
     file_id = form["file_id"]
-    fname = File.query.get(file_id).fname
+    fname = getFile(file_id).fname
     line_segment = form["linesegment"]
 
-    data = getCoordinateData(fname)
+    def makeDisplay(data):
+        poi = data["poi"].get(line_segment)
+        if poi is None:
+            return None
+        display = {}
+        for i, p in enumerate(poi):
+            if (f"show_{i+1}" in form.keys()) != p["display"]:
+                display[i] = f"show_{i+1}" in form.keys()
+        if display:
+            return {"op": "display", "line": line_segment, "display": display}
 
-    for i, p in enumerate(data["poi"][line_segment]):
-        if f"show_{i+1}" in form.keys():
-            p["display"] = True
-        else:
-            p["display"] = False
-    saveCoordinateData(fname, data)
+    updateCoordinateData(fname, makeDisplay, copy=False)
@@ -0,0 +1,32 @@
+"""
+Settings of the production server, started with
+    gunicorn -c gunicorn.conf.py server:app
+Every worker process imports the app itself, so none of its state is shared.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("MZB_BIND", "0.0.0.0:80")
+workers = int(os.environ.get("MZB_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("MZB_THREADS", 4))
+worker_class = "gthread"
+
+# Bulk exports stream for a while, uploads are processed by the job queue
+timeout = 120
+graceful_timeout = 30
+
+accesslog = "-"
+
+
+def when_ready(server):
+    # One job runner for all workers, the master keeps it running
+    from jobs import JOB_BACKEND, JobRunner
+
+    if JOB_BACKEND == "process":
+        server.job_runner = JobRunner()
+
+
+def on_exit(server):
+    # Killed jobs run again with the next job runner
+    if hasattr(server, "job_runner"):
+        server.job_runner.stop(graceful_timeout)
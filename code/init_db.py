@@ -1,3 +1,4 @@
+from sqlalchemy import inspect, text
 from db.database import db
 from db.models import User
 from server import app
@@ -6,9 +7,25 @@ from server import app
 def main():
     with app.app_context():
         db.create_all()
+        add_missing_columns()
+        add_missing_indexes()
         init_admin_user()
 
 
+def add_missing_columns():
+    """create_all does not alter existing tables, columns added later are added here"""
+    columns = [c["name"] for c in inspect(db.engine).get_columns("file")]
+    if "status" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE file ADD COLUMN status VARCHAR(20)"))
+
+
+def add_missing_indexes():
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
 def init_admin_user():
     if User.query.get(1):
         return
@@ -0,0 +1,304 @@
+"""
+Uploads are processed outside of the request. The uploaded KML is written to
+JOB_FILE_LOCATION, which is the queue: one job runner per host picks up every upload
+in it, runs the pipeline on its worker processes and reports the stage a job is in
+through a small status file next to the upload, which the web server reads.
+Uploads stay until their job finished, so jobs interrupted by a restart run again.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+JOB_FILE_LOCATION = "db/jobs/"
+JOB_BACKEND = os.environ.get("MZB_JOB_BACKEND", "process")
+# Worker processes of the job runner, for the whole host
+JOB_WORKERS = int(os.environ.get("MZB_JOB_WORKERS", 2))
+# Seconds between two looks of the job runner for new uploads
+JOB_POLL_SECONDS = 1
+# Seconds before a job runner which died is started again
+JOB_RUNNER_RESTART_SECONDS = 5
+# Job processes log to stderr, which gunicorn and docker collect with their own output
+JOB_LOG_FORMAT = "[%(asctime)s] [%(process)d] [%(levelname)s] %(name)s: %(message)s"
+
+QUEUED = "queued"
+DONE = "done"
+FAILED = "failed"
+STAGES = ("parsing", "profiles", "combining", "markers", "poi", "saving")
+STATUS_LABELS = {
+    QUEUED: "In der Warteschlange",
+    "parsing": "Datei wird gelesen",
+    "profiles": "Höhenprofile werden geladen",
+    "combining": "Strecken werden verbunden",
+    "markers": "Markierungen werden zugeordnet",
+    "poi": "Punkte werden berechnet",
+    "saving": "Wird gespeichert",
+    DONE: "Fertig",
+    FAILED: "Fehlgeschlagen",
+}
+
+
+def uploadPath(fname):
+    return os.path.join(JOB_FILE_LOCATION, fname + ".upload")
+
+
+def partPath(fname):
+    """Uploads are saved here until their File exists, the job runner ignores them"""
+    return uploadPath(fname) + ".part"
+
+
+def statusPath(fname):
+    return os.path.join(JOB_FILE_LOCATION, fname + ".json")
+
+
+def writeStatus(fname, status, error=None):
+    os.makedirs(JOB_FILE_LOCATION, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=JOB_FILE_LOCATION, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"status": status, "error": error}, f)
+    os.replace(tmp, statusPath(fname))
+
+
+def readStatus(fname):
+    """Returns the status of a job, None once there is no job for fname"""
+    try:
+        with open(statusPath(fname), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def removeJob(fname):
+    for path in (partPath(fname), uploadPath(fname), statusPath(fname)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def progress(status):
+    """Returns the stage index and count of a status, for progress bars"""
+    if status == DONE:
+        return len(STAGES), len(STAGES)
+    if status in STAGES:
+        return STAGES.index(status), len(STAGES)
+    return 0, len(STAGES)
+
+
+def pendingJobs():
+    """Returns the fnames of the queued uploads whose job has not finished"""
+    try:
+        names = sorted(os.listdir(JOB_FILE_LOCATION))
+    except FileNotFoundError:
+        return []
+    pending = []
+    for name in names:
+        if name.endswith(".upload"):
+            fname = name[: -len(".upload")]
+            job = readStatus(fname)
+            if job is None or job["status"] not in (DONE, FAILED):
+                pending.append(fname)
+    return pending
+
+
+def runJob(fname):
+    """Runs the upload pipeline for the queued upload of fname"""
+    # Imported here, so worker processes only load the pipeline once they start
+    from flask import has_app_context
+    from geo_admin_tools import combineAndSave
+
+    try:
+        with open(uploadPath(fname), "rb") as f:
+            report = lambda stage: writeStatus(fname, stage)
+            if has_app_context():
+                saved = combineAndSave(f, fname, report)
+            else:
+                # Worker processes need the app to look up the File of the job
+                from server import app
+
+                with app.app_context():
+                    saved = combineAndSave(f, fname, report)
+    except Exception as e:
+        writeStatus(fname, FAILED, f"{type(e).__name__}: {e}")
+    else:
+        if saved:
+            writeStatus(fname, DONE)
+        else:
+            # The File was deleted meanwhile, nothing may be left of the job
+            removeJob(fname)
+    finally:
+        try:
+            os.remove(uploadPath(fname))
+        except FileNotFoundError:
+            pass
+
+
+logger = logging.getLogger(__name__)
+
+
+def setupLogging():
+    logging.basicConfig(level=logging.INFO, format=JOB_LOG_FORMAT)
+
+
+def setupWorker():
+    setupLogging()
+    # Interrupts are for the runner, which lets running jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class WorkerPool:
+    """Runs jobs on local worker processes, each fname once at a time"""
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.running = set()
+        self.executor = self.createExecutor()
+
+    def createExecutor(self):
+        # Forking a threaded process is not safe, workers start fresh instead
+        return ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=setupWorker,
+        )
+
+    def submit(self, fname):
+        with self.lock:
+            if fname in self.running:
+                return
+            try:
+                future = self.executor.submit(runJob, fname)
+            except BrokenProcessPool:
+                # A worker which died breaks the whole pool, its jobs failed with it
+                self.executor.shutdown(wait=False)
+                self.executor = self.createExecutor()
+                future = self.executor.submit(runJob, fname)
+            self.running.add(fname)
+        future.add_done_callback(lambda f: self.finished(fname, f))
+
+    def finished(self, fname, future):
+        # runJob reports its own errors, this is for workers which died
+        if future.exception() is not None:
+            writeStatus(fname, FAILED, str(future.exception()))
+            try:
+                os.remove(uploadPath(fname))
+            except FileNotFoundError:
+                pass
+        self.running.discard(fname)
+
+
+def runJobs(poll=JOB_POLL_SECONDS, workers=JOB_WORKERS):
+    """
+    The job runner, runs every pending upload until it gets SIGTERM or SIGINT, then
+    waits for the running jobs. Uploads left over from before a restart are pending too.
+    """
+    setupLogging()
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+
+    pool = WorkerPool(workers)
+    while not stop.is_set():
+        for fname in pendingJobs():
+            pool.submit(fname)
+        stop.wait(poll)
+    pool.executor.shutdown(cancel_futures=True)
+
+
+class JobRunner:
+    """
+    Runs runJobs in its own process and starts it again should it die.
+    gunicorn.conf.py keeps one per host, python3 server.py one of its own.
+    """
+
+    def __init__(self, restart=JOB_RUNNER_RESTART_SECONDS):
+        self.restart = restart
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.process = self.spawn()
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    @staticmethod
+    def spawn():
+        return subprocess.Popen([sys.executable, "-m", "jobs"])
+
+    def watch(self):
+        while True:
+            code = self.process.wait()
+            time.sleep(self.restart)
+            with self.lock:
+                if self.stopping:
+                    return
+                logger.warning("Job runner exited with %s, starting it again", code)
+                self.process = self.spawn()
+
+    def stop(self, timeout):
+        """Stops the runner, running jobs which take longer than timeout are killed"""
+        with self.lock:
+            self.stopping = True
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class ProcessJobQueue:
+    """
+    Leaves the jobs to the job runner, which finds submitted uploads by itself and
+    runs them on its worker processes
+    """
+
+    def submit(self, fname):
+        pass
+
+
+class InProcessJobQueue:
+    """Runs every job right away in the submitting thread, for tests and debugging"""
+
+    def submit(self, fname):
+        runJob(fname)
+
+
+JOB_QUEUES = {"process": ProcessJobQueue, "inprocess": InProcessJobQueue}
+
+_queue = None
+
+
+def getJobQueue():
+    global _queue
+    if _queue is None:
+        _queue = JOB_QUEUES[JOB_BACKEND]()
+    return _queue
+
+
+def setJobQueue(queue):
+    global _queue
+    _queue = queue
+
+
+def saveUpload(fname, file):
+    """Writes an uploaded file to disk as a queued job, submit it once its File exists"""
+    os.makedirs(JOB_FILE_LOCATION, exist_ok=True)
+    file.save(partPath(fname))
+    writeStatus(fname, QUEUED)
+
+
+def submitJob(fname):
+    """Hands a saved upload to the job runner"""
+    os.replace(partPath(fname), uploadPath(fname))
+    getJobQueue().submit(fname)
+
+
+if __name__ == "__main__":
+    runJobs()
@@ -0,0 +1,129 @@
+"""
+Incremental reader for uploads. KML, KMZ and GPX files are parsed with iterparse,
+elements are freed as soon as they were read, so only the coordinates are kept.
+Lines are (n, 2) arrays of longitude and latitude, markers (title, longitude, latitude).
+"""
+import zipfile
+import numpy as np
+from lxml import etree
+
+ZIP_MAGIC = b"PK\x03\x04"
+KMZ_DOCUMENT = "doc.kml"
+
+# Points drawn on map.geo.admin.ch which are not markers
+IGNORED_POINT_IDS = ("annotation",)
+
+
+def localName(tag):
+    return tag.rpartition("}")[2]
+
+
+def free(element):
+    """Clears a read element and the siblings before it, which were read already"""
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def parseCoordinates(text):
+    """Parses KML coordinates, tuples of longitude,latitude[,altitude], in one go"""
+    tuples = (text or "").split()
+    if not tuples:
+        return np.empty((0, 2))
+    width = tuples[0].count(",") + 1
+    values = np.array(",".join(tuples).split(","), dtype=float)
+    if values.size != len(tuples) * width:
+        # Tuples with and without altitude mixed
+        return np.array([t.split(",")[:2] for t in tuples], dtype=float)
+    return values.reshape(-1, width)[:, :2]
+
+
+def readUpload(source):
+    """Returns the lines, by id, and the markers of an uploaded KML, KMZ or GPX file"""
+    head = source.read(len(ZIP_MAGIC))
+    source.seek(0)
+    if head != ZIP_MAGIC:
+        return readXML(source)
+
+    with zipfile.ZipFile(source) as zf:
+        names = [n for n in zf.namelist() if n.lower().endswith(".kml")]
+        if not names:
+            raise ValueError("KMZ file without KML document")
+        name = KMZ_DOCUMENT if KMZ_DOCUMENT in names else names[0]
+        with zf.open(name) as document:
+            return readXML(document)
+
+
+def readXML(source):
+    context = etree.iterparse(
+        source,
+        events=("start", "end"),
+        huge_tree=True,
+        remove_comments=True,
+        remove_pis=True,
+    )
+    _, root = next(context)
+    if localName(root.tag) == "gpx":
+        return readGPX(context)
+    return readKML(context)
+
+
+def readKML(context):
+    lines = {}
+    markers = []
+    for event, element in context:
+        if event != "end" or localName(element.tag) != "Placemark":
+            continue
+        placemark_id = element.get("id")
+        name = element.findtext("{*}name") or ""
+
+        line_id = placemark_id or f"line_{len(lines)}"
+        for i, coordinates in enumerate(
+            element.iterfind(".//{*}LineString/{*}coordinates")
+        ):
+            lines[line_id if i == 0 else f"{line_id}_{i}"] = parseCoordinates(
+                coordinates.text
+            )
+
+        point = element.find(".//{*}Point/{*}coordinates")
+        if point is not None and not (
+            placemark_id and any(i in placemark_id for i in IGNORED_POINT_IDS)
+        ):
+            coords = parseCoordinates(point.text)
+            if len(coords):
+                markers.append((name, coords[0, 0], coords[0, 1]))
+        free(element)
+    return lines, markers
+
+
+def readGPX(context):
+    """Every segment of a track and every route is a line, waypoints are markers"""
+    lines = {}
+    markers = []
+    points = []
+    for event, element in context:
+        if event != "end":
+            continue
+        tag = localName(element.tag)
+        if tag in ("trkpt", "rtept"):
+            points.append((element.get("lon"), element.get("lat")))
+        elif tag in ("trkseg", "rte"):
+            prefix = "track" if tag == "trkseg" else "route"
+            lines[f"{prefix}_{len(lines)}"] = np.array(points, dtype=float).reshape(
+                -1, 2
+            )
+            points = []
+        elif tag == "wpt":
+            markers.append(
+                (
+                    element.findtext("{*}name") or "",
+                    float(element.get("lon")),
+                    float(element.get("lat")),
+                )
+            )
+        else:
+            continue
+        free(element)
+    return lines, markers
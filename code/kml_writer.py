@@ -0,0 +1,150 @@
+import functools
+import io
+from lxml import etree
+
+KML_BASE_LOCATION = "files/kml/base.kml"
+KML_NAMESPACE = "http://www.opengis.net/kml/2.2"
+GX_NAMESPACE = "http://www.google.com/kml/ext/2.2"
+
+# Stream the output in pieces of roughly this size
+KML_CHUNK_BYTES = 64 * 1024
+
+LINE_TEMPLATE = """
+<Placemark>
+  <ExtendedData>
+    <Data name="overlays"/>
+    <Data name="type">
+      <value>measure</value>
+    </Data>
+  </ExtendedData>
+  <Style>
+    <LineStyle>
+      <color>ff0000ff</color>
+      <width>3</width>
+    </LineStyle>
+    <PolyStyle>
+      <color>660000ff</color>
+    </PolyStyle>
+  </Style>
+</Placemark>"""
+
+MARKER_TEMPLATE = """
+<Placemark>
+  <ExtendedData>
+    <Data name="type">
+      <value>marker</value>
+    </Data>
+  </ExtendedData>
+  <Style>
+    <IconStyle>
+      <Icon>
+        <href>https://api3.geo.admin.ch/color/255,0,0/marker-24@2x.png</href>
+        <gx:w>48</gx:w>
+        <gx:h>48</gx:h>
+      </Icon>
+      <hotSpot x="24" y="4.799999999999997" xunits="pixels" yunits="pixels"/>
+    </IconStyle>
+    <LabelStyle>
+      <color>ff0000ff</color>
+    </LabelStyle>
+  </Style>
+</Placemark>"""
+
+
+def kml(tag):
+    return f"{{{KML_NAMESPACE}}}{tag}"
+
+
+@functools.lru_cache(maxsize=None)
+def getBaseTemplate():
+    """
+    Returns the root tag, namespaces and attributes of the base KML and the tag of its
+    Document, parsed once
+    """
+    with open(KML_BASE_LOCATION, "rb") as f:
+        root = etree.parse(f).getroot()
+    document = root.find(kml("Document"))
+    return root.tag, dict(root.nsmap), dict(root.attrib), document.tag
+
+
+@functools.lru_cache(maxsize=None)
+def getPlacemarkTemplate(template):
+    """Returns the static children of a placemark template, parsed once"""
+    parser = etree.XMLParser(remove_blank_text=True)
+    placemark = etree.fromstring(
+        template.replace(
+            "<Placemark>",
+            f'<Placemark xmlns="{KML_NAMESPACE}" xmlns:gx="{GX_NAMESPACE}">',
+            1,
+        ),
+        parser,
+    )
+    return list(placemark)
+
+
+def writeElement(xf, element):
+    """Writes a parsed element through xf, reusing the namespaces declared by the root"""
+    with xf.element(element.tag, dict(element.attrib)):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            writeElement(xf, child)
+
+
+def writeTextElement(xf, tag, text):
+    with xf.element(kml(tag)):
+        xf.write(text)
+
+
+def writeLine(xf, name, lat, lng):
+    with xf.element(kml("Placemark"), id=name):
+        for element in getPlacemarkTemplate(LINE_TEMPLATE):
+            writeElement(xf, element)
+        with xf.element(kml("LineString")):
+            writeTextElement(xf, "tessellate", "1")
+            writeTextElement(xf, "altitudeMode", "clampToGround")
+            writeTextElement(xf, "coordinates", " ".join(map("{},{}".format, lng, lat)))
+
+
+def writeMarker(xf, index, title, lat, lng):
+    with xf.element(kml("Placemark"), id=f"marker_{index}_generated"):
+        extended_data, style = getPlacemarkTemplate(MARKER_TEMPLATE)
+        writeElement(xf, extended_data)
+        writeTextElement(xf, "name", title)
+        with xf.element(kml("description")):
+            pass
+        writeElement(xf, style)
+        with xf.element(kml("Point")):
+            writeTextElement(xf, "tessellate", "1")
+            writeTextElement(xf, "altitudeMode", "clampToGround")
+            writeTextElement(xf, "coordinates", f"{lng},{lat}")
+
+
+def iterKML(lines, markers, chunk_bytes=KML_CHUNK_BYTES):
+    """
+    Generates a KML document in chunks of bytes.
+    lines is an iterable of (name, lats, lngs), markers one of (title, lat, lng).
+    """
+    root_tag, nsmap, attrib, document_tag = getBaseTemplate()
+    buffer = io.BytesIO()
+
+    def drain():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    with etree.xmlfile(buffer, encoding="utf-8") as xf:
+        with xf.element(root_tag, attrib, nsmap=nsmap):
+            with xf.element(document_tag):
+                for name, lat, lng in lines:
+                    writeLine(xf, name, lat, lng)
+                    xf.flush()
+                    if buffer.tell() >= chunk_bytes:
+                        yield drain()
+                for i, (title, lat, lng) in enumerate(markers):
+                    writeMarker(xf, i, title, lat, lng)
+                    xf.flush()
+                    if buffer.tell() >= chunk_bytes:
+                        yield drain()
+    yield drain()
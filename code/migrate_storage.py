@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+from db.db_utils import (
+    JSON_FILE_LOCATION,
+    COLUMNAR_FILE_LOCATION,
+    jsonPath,
+    columnarPath,
+    oplogPath,
+    readOperations,
+    fileLock,
+    atomicWrite,
+)
+from db.columnar import writeColumnar, readColumnar
+from db.oplog import applyOperation
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert stored coordinate data between the JSON and columnar formats"
+    )
+    parser.add_argument("target", choices=["columnar", "json"])
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the files in the old format"
+    )
+    args = parser.parse_args()
+
+    if args.target == "columnar":
+        source, extension, convert = JSON_FILE_LOCATION, ".json", toColumnar
+    else:
+        source, extension, convert = COLUMNAR_FILE_LOCATION, ".bin", toJson
+    if not os.path.isdir(source):
+        return
+
+    for entry in sorted(os.listdir(source)):
+        if not entry.endswith(extension):
+            continue
+        name = entry[: -len(extension)]
+        with fileLock(name):
+            convert(name)
+            if not args.keep:
+                os.remove(source + entry)
+        print(f"Converted {name}")
+
+
+def toColumnar(name):
+    with open(jsonPath(name), "r") as f:
+        data = json.load(f)
+    data = foldOperations(name, data)
+    atomicWrite(columnarPath(name), lambda f: writeColumnar(f, data), True)
+    removeOperations(name)
+
+
+def toJson(name):
+    data = foldOperations(name, readColumnar(columnarPath(name)))
+    atomicWrite(jsonPath(name), lambda f: json.dump(data, f))
+    removeOperations(name)
+
+
+def foldOperations(name, data):
+    for op in readOperations(name):
+        applyOperation(data, op)
+    return data
+
+
+def removeOperations(name):
+    if os.path.exists(oplogPath(name)):
+        os.remove(oplogPath(name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import numpy as np
+
+# Cell keys are built as cx * CELL_KEY_STRIDE + cy, LV03 cells are far below this
+CELL_KEY_STRIDE = 10**7
+
+
+class SegmentIndex:
+    """
+    Uniform grid over the segments of a line.
+    Every segment is registered in all cells its bounding box touches, the
+    (cell, segment) pairs are kept sorted by cell so that a query is a few
+    binary searches followed by a vectorized projection onto the candidates.
+    """
+
+    def __init__(self, east, north, cell_size):
+        east = np.asarray(east, dtype=float)
+        north = np.asarray(north, dtype=float)
+        self.cell_size = cell_size
+        self.x1, self.y1 = east[:-1], north[:-1]
+        self.dx, self.dy = np.diff(east), np.diff(north)
+
+        cx0 = np.floor(np.minimum(east[:-1], east[1:]) / cell_size).astype(np.int64)
+        cx1 = np.floor(np.maximum(east[:-1], east[1:]) / cell_size).astype(np.int64)
+        cy0 = np.floor(np.minimum(north[:-1], north[1:]) / cell_size).astype(np.int64)
+        cy1 = np.floor(np.maximum(north[:-1], north[1:]) / cell_size).astype(np.int64)
+        width = cx1 - cx0 + 1
+        counts = width * (cy1 - cy0 + 1)
+
+        segments = np.repeat(np.arange(len(counts)), counts)
+        # Position of every entry within the bounding box of its segment
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = cx0[segments] + offset % width[segments]
+        cy = cy0[segments] + offset // width[segments]
+        keys = cx * CELL_KEY_STRIDE + cy
+
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.segments = segments[order]
+
+    def candidates(self, x, y, radius):
+        cells_x = np.arange(
+            np.floor((x - radius) / self.cell_size),
+            np.floor((x + radius) / self.cell_size) + 1,
+            dtype=np.int64,
+        )
+        cells_y = np.arange(
+            np.floor((y - radius) / self.cell_size),
+            np.floor((y + radius) / self.cell_size) + 1,
+            dtype=np.int64,
+        )
+        keys = np.add.outer(cells_x * CELL_KEY_STRIDE, cells_y).ravel()
+        lo = np.searchsorted(self.keys, keys, side="left")
+        hi = np.searchsorted(self.keys, keys, side="right")
+        if not (hi - lo).any():
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.segments[a:b] for a, b in zip(lo, hi)]))
+
+    def nearest(self, x, y, radius):
+        """
+        Returns the index of the closest segment within radius of (x, y),
+        the fraction along that segment of the closest point and its distance,
+        or None if no segment is that close
+        """
+        segments = self.candidates(x, y, radius)
+        if not len(segments):
+            return None
+
+        x1, y1 = self.x1[segments], self.y1[segments]
+        dx, dy = self.dx[segments], self.dy[segments]
+        det = dx * dx + dy * dy
+        with np.errstate(invalid="ignore", divide="ignore"):
+            a = np.where(det > 0, ((x - x1) * dx + (y - y1) * dy) / det, 0)
+        a = np.clip(a, 0, 1)
+        dist = np.hypot(x1 + a * dx - x, y1 + a * dy - y)
+
+        best = int(np.argmin(dist))
+        if dist[best] > radius:
+            return None
+        return int(segments[best]), float(a[best]), float(dist[best])
@@ -9,19 +9,46 @@ from flask_login import (
 )
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-import plotly.graph_objects as go
-import plotly
-import tempfile
+import json
+import hashlib
+import unicodedata
+from urllib.parse import quote
 from geo_admin_tools import *
 from db.database import db
-from db.db_utils import JSON_FILE_LOCATION
-from db.models import User, File, Suggestion
-from utils import getCurrentTimeString
+from db.db_utils import JSON_FILE_LOCATION, documentStamp, getLineColumns
+from downsample import downsampleProfile
+from kml_writer import KML_BASE_LOCATION
+from xlsx_writer import XLSX_BASE_LOCATION
+from db.document_cache import document_cache, DocumentCache
+from db.profile_cache import profile_cache
+from db.models import User, File, Suggestion, getFile, getUser
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+from utils import getUniqueId
+from jobs import (
+    JOB_BACKEND,
+    QUEUED,
+    DONE,
+    STATUS_LABELS,
+    saveUpload,
+    submitJob,
+    JobRunner,
+    progress,
+)
+
+# Threads per worker process, see gunicorn.conf.py
+WORKER_THREADS = int(os.environ.get("MZB_THREADS", 4))
 
 app = Flask(__name__)
 
 app.config["SECRET_KEY"] = "PnC3Xr?nxgjsXN$o"
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///db.sqlite"
+# Every worker process has its own pool, with a connection for each of its threads
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": WORKER_THREADS,
+    "max_overflow": WORKER_THREADS,
+    "pool_timeout": 30,
+}
 
 db.init_app(app)
 
@@ -33,12 +60,20 @@ login_manager.login_message = "Du musst angemeldet sein, um diese Seite zu sehen
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return getUser(user_id)
 
 
 KML_FILE_LOCATION = "./files/kml/"
 XLSX_FILE_LOCATION = "./files/xlsx/"
 
+# Rows per page of the file and user lists
+PAGE_SIZE = 50
+
+# Elevation profiles are reduced to about this many points for display
+PLOT_PROFILE_POINTS = 500
+# Serialized plot specs, keyed like the documents they are generated from
+plot_cache = DocumentCache(max_bytes=16 * 1024 * 1024)
+
 
 @app.route("/")
 def index():
@@ -107,10 +142,34 @@ def admin():
         flash("Du hast keine Admin Berechtigungen!")
         return redirect(url_for("home"))
 
-    users = User.query.all()
+    # Both lists page on their own, the links keep the position of the other one
+    users_before = request.args.get("users", type=int)
+    suggestions_before = request.args.get("suggestions", type=int)
+    users, next_users = keysetPage(User.query, User.id, users_before)
+    file_counts = dict(
+        db.session.query(File.uploaded_by_userid, func.count(File.id))
+        .filter(File.uploaded_by_userid.in_([u.id for u in users]))
+        .group_by(File.uploaded_by_userid)
+        .all()
+    )
+    suggestions, next_suggestions = keysetPage(
+        Suggestion.query.options(joinedload(Suggestion.uploaded_by)),
+        Suggestion.id,
+        suggestions_before,
+    )
 
     return render_template(
-        "admin.html", users=users, user=current_user, suggestions=Suggestion.query.all()
+        "admin.html",
+        users=users,
+        file_counts=file_counts,
+        next_users=next_users,
+        users_before=users_before,
+        user=current_user,
+        suggestions=suggestions,
+        next_suggestions=next_suggestions,
+        suggestions_before=suggestions_before,
+        document_cache=document_cache.stats(),
+        profile_cache=profile_cache.stats(),
     )
 
 
@@ -161,8 +220,20 @@ def add_suggestion():
 @app.route("/home")
 @login_required
 def home():
-    files = current_user.files
-    return render_template("home.html", files=files, user=current_user)
+    files, next_files = keysetPage(
+        File.query.filter_by(uploaded_by_userid=current_user.id),
+        File.id,
+        request.args.get("before", type=int),
+    )
+    for file in files:
+        refreshStatus(file)
+    return render_template(
+        "home.html",
+        files=files,
+        next_files=next_files,
+        user=current_user,
+        labels=STATUS_LABELS,
+    )
 
 
 @app.route("/upload", methods=["POST"])
@@ -175,34 +246,55 @@ def upload_kml():
         return "No file uploaded"
 
     current_files = os.listdir(KML_FILE_LOCATION)
-    fname = getCurrentTimeString()
+    fname = getUniqueId()
     while f"{fname}.json" in current_files:
         fname = str(int(fname) + 1)
     if file:
+        saveUpload(fname, file)
         new_file = File(
             title=file.filename.split(".")[0],
             fname=fname,
+            status=QUEUED,
+            uploaded_by_userid=current_user.id,
         )
-        current_user.files.append(new_file)
+        db.session.add(new_file)
         db.session.commit()
-        combineAndSave(file, fname)
+        submitJob(fname)
 
         return redirect(url_for("home"))
 
 
+@app.route("/upload_status/<file_id>")
+@login_required
+def upload_status(file_id):
+    file = getFile(file_id)
+    if file.uploaded_by_userid != current_user.id:
+        return "", 403
+    job = refreshStatus(file)
+    stage, stages = progress(job["status"])
+    return {
+        "status": job["status"],
+        "label": STATUS_LABELS.get(job["status"], job["status"]),
+        "stage": stage,
+        "stages": stages,
+        "error": job["error"],
+    }
+
+
 @app.route("/edit_kml/<file_id>")
 @login_required
 def edit_kml(file_id):
-    file = File.query.get(file_id)
+    file = getFile(file_id)
     if file.uploaded_by_userid != current_user.id:
         flash("Du hast keine Berechtigungen auf diese Datei!")
         return redirect(url_for("home"))
-    data = getCoordinateData(file.fname)
-    plots = createPlots(data["poi"], data["coords"])
+    if refreshStatus(file)["status"] != DONE:
+        flash("Diese Datei wird noch verarbeitet oder konnte nicht verarbeitet werden!")
+        return redirect(url_for("home"))
+    data = getCoordinateData(file.fname, copy=False)
 
     return render_template(
         "edit_kml.html",
-        plots=plots,
         file=file,
         poi=data["poi"],
         center=getCenterCoords(data["coords"]),
@@ -210,6 +302,24 @@ def edit_kml(file_id):
     )
 
 
+@app.route("/plot_data/<file_id>")
+@login_required
+def plot_data(file_id):
+    file = getFile(file_id)
+    if file.uploaded_by_userid != current_user.id:
+        return "", 403
+
+    stamp = documentStamp(file.fname)
+    spec = plot_cache.get(file.fname, stamp)
+    if spec is None:
+        data = getCoordinateData(file.fname, copy=False)
+        spec = json.dumps(
+            createPlotSpec(file.fname, data["poi"]), separators=(",", ":")
+        ).encode()
+        plot_cache.put(file.fname, stamp, spec, len(spec))
+    return app.response_class(spec, mimetype="application/json")
+
+
 @app.route("/delete_kml/<file_id>")
 @login_required
 def delete_kml(file_id):
@@ -219,27 +329,39 @@ def delete_kml(file_id):
 
 @app.route("/download_kml/<file_id>/<line_name>")
 def download_kml(file_id, line_name):
-    file = File.query.get(file_id)
+    file = getFile(file_id)
     fname = file.fname
-    tmp = tempfile.TemporaryFile()
-    content = generate_kml(fname, line_name)
-    tmp.write(content)
-    tmp.seek(0)
-    return send_file(
-        tmp, as_attachment=True, download_name=f"{file.title}_{line_name}.kml"
+    return conditionalDownload(
+        downloadETag(fname, KML_BASE_LOCATION, "kml", line_name),
+        lambda: generate_kml(fname, line_name),
+        f"{file.title}_{line_name}.kml",
+        "application/vnd.google-earth.kml+xml",
     )
 
 
 @app.route("/download_xlsx/<file_id>/<line_name>")
 def download_xlsx(file_id, line_name):
-    file = File.query.get(file_id)
+    file = getFile(file_id)
     fname = file.fname
-    tmp = tempfile.NamedTemporaryFile(suffix=".xlsx")
-    book = generate_xlsx(fname, line_name)
-    book.save(tmp)
-    tmp.seek(0)
-    return send_file(
-        tmp, as_attachment=True, download_name=f"{file.title}_{line_name}.xlsx"
+    return conditionalDownload(
+        downloadETag(fname, XLSX_BASE_LOCATION, "xlsx", line_name),
+        lambda: generate_xlsx(fname, line_name),
+        f"{file.title}_{line_name}.xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
+@app.route("/download_all/<file_id>")
+@login_required
+def download_all(file_id):
+    file = getFile(file_id)
+    if file.uploaded_by_userid != current_user.id:
+        flash("Du hast keine Berechtigungen auf diese Datei!")
+        return redirect(url_for("home"))
+    return attachmentResponse(
+        generate_zip(file.fname, file.title, "combined" in request.args),
+        f"{file.title}.zip",
+        "application/zip",
     )
 
 
@@ -247,11 +369,18 @@ def download_xlsx(file_id, line_name):
 @login_required
 def break_kml():
     file_id = request.form["file_id"]
-    break_point = request.form["breaker"]
     line_segment = request.form["linesegment"]
 
-    fname = File.query.get(file_id).fname
-    breakLineAtPoint(fname, line_segment, break_point)
+    fname = getFile(file_id).fname
+    if "distance" in request.form:
+        try:
+            distance = float(request.form["distance"]) * 1000
+        except ValueError:
+            distance = None
+        if distance is None or not breakLineAtDistance(fname, line_segment, distance):
+            flash("Diese Distanz liegt nicht auf der Strecke!")
+    else:
+        breakLineAtPoint(fname, line_segment, request.form["breaker"])
     return redirect(url_for("edit_kml", file_id=file_id))
 
 
@@ -266,46 +395,95 @@ def update_poi():
     return redirect(url_for("edit_kml", file_id=file_id))
 
 
-def createPlots(poi, coords):
+def attachmentResponse(body, download_name, mimetype):
+    """
+    Returns a response which downloads body, bytes or a generator of bytes, as download_name.
+    The Content-Disposition header is built the same way send_file does.
+    """
+    response = app.response_class(body, mimetype=mimetype)
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        names = {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    else:
+        names = {"filename": download_name}
+    response.headers.set("Content-Disposition", "attachment", **names)
+    return response
+
+
+def keysetPage(query, column, before=None, size=PAGE_SIZE):
+    """
+    Returns the rows of query, newest first by column, which come before the key before,
+    and the key of the next page or None. Unlike an offset, the key is found through
+    the index, however far back the page is.
+    """
+    if before is not None:
+        query = query.filter(column < before)
+    rows = query.order_by(column.desc()).limit(size + 1).all()
+    if len(rows) > size:
+        return rows[:size], getattr(rows[size - 1], column.key)
+    return rows, None
+
+
+def downloadETag(fname, template, *parts):
+    """
+    Returns a strong ETag of a download, which changes with the version of the document
+    and of the template it is generated from. Only the files are stat'ed, nothing is read.
+    """
+    stamp = documentStamp(fname)
+    version = (fname, stamp, os.stat(template).st_mtime_ns, parts)
+    return hashlib.sha1(repr(version).encode()).hexdigest()
+
+
+def conditionalDownload(etag, generate, download_name, mimetype):
+    """
+    Answers with 304 if the client has the download with this ETag already,
+    only otherwise generate is called for the body.
+    Clients may store downloads but have to revalidate them before every use.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = attachmentResponse(generate(), download_name, mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def createPlotSpec(fname, poi):
+    """
+    Returns the series of the elevation plot of every line as plain arrays,
+    the figures themselves are drawn in the browser by elevation_plot.js.
+    Profiles are downsampled to PLOT_PROFILE_POINTS, keeping every POI.
+    """
     out = {}
-    for key, item in coords.items():
-        out[key] = []
-        for template in ["plotly", "plotly_dark"]:
-            fig = go.Figure()
-            fig.add_trace(
-                go.Scatter(
-                    x=[p["dist"] for p in poi[key]],
-                    y=[p["alt"] for p in poi[key]],
-                    hovertemplate="Distanz: %{x} m, Höhe: %{y} m",
-                    name="MZB",
-                )
-            )
-            fig.add_trace(
-                go.Scatter(
-                    x=[p["dist"] for p in item],
-                    y=[p["alt"] for p in item],
-                    hovertemplate="Distanz: %{x} m, Höhe: %{y} m",
-                    name="Profil",
-                )
-            )
-
-            fig.update_layout(
-                xaxis_title="Distanz (m)",
-                yaxis_title="Höhe (m)",
-                title_text="",
-                template=template,
-                width=400,
-                height=300,
-                paper_bgcolor="rgba(0,0,0,0)",
-                plot_bgcolor="rgba(0,0,0,0)",
-            )
-
-            out[key].append(
-                plotly.offline.plot(fig, include_plotlyjs=False, output_type="div")
-            )
-
+    for key, points in poi.items():
+        columns = getLineColumns(fname, key)
+        poi_dist = [p["dist"] for p in points]
+        indices = downsampleProfile(
+            columns["dist"], columns["alt"], PLOT_PROFILE_POINTS, poi_dist
+        )
+        out[key] = {
+            "poi": {
+                "dist": poi_dist,
+                "alt": [p["alt"] for p in points],
+            },
+            "profile": {
+                "dist": columns["dist"][indices].tolist(),
+                "alt": columns["alt"][indices].tolist(),
+            },
+        }
     return out
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=80)
+    job_runner = JobRunner() if JOB_BACKEND == "process" else None
+    try:
+        app.run(host="0.0.0.0", port=80)
+    finally:
+        if job_runner:
+            job_runner.stop(30)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def rdp(x, y, tolerance, keep=None):
+    """
+    Ramer–Douglas–Peucker simplification of a line, returns a mask of the kept vertices.
+    Vertices where keep is True are always kept. Instead of recursing, every range
+    between two kept vertices is split at its farthest vertex at the same time.
+    """
+    n = len(x)
+    mask = np.zeros(n, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    if n <= 2:
+        mask[:] = True
+        return mask
+    mask[[0, -1]] = True
+
+    kept = np.flatnonzero(mask)
+    starts, ends = kept[:-1], kept[1:]
+    while True:
+        inner = ends - starts > 1
+        starts, ends = starts[inner], ends[inner]
+        if not len(starts):
+            return mask
+
+        # Every vertex inside a range, with the range it belongs to
+        lengths = ends - starts - 1
+        first = np.cumsum(lengths) - lengths
+        range_of = np.repeat(np.arange(len(starts)), lengths)
+        points = np.arange(lengths.sum()) - first[range_of] + starts[range_of] + 1
+
+        ax, ay = x[starts][range_of], y[starts][range_of]
+        dx, dy = x[ends][range_of] - ax, y[ends][range_of] - ay
+        length2 = dx * dx + dy * dy
+        px, py = x[points] - ax, y[points] - ay
+        # Distance to the segment, which also works for closed loops
+        t = np.clip((px * dx + py * dy) / np.where(length2 > 0, length2, 1), 0, 1)
+        dist = np.hypot(px - t * dx, py - t * dy)
+
+        farthest = np.maximum.reduceat(dist, first)
+        split = farthest > tolerance
+        candidates = np.flatnonzero((dist == farthest[range_of]) & split[range_of])
+        _, unique = np.unique(range_of[candidates], return_index=True)
+        split_points = points[candidates[unique]]
+
+        mask[split_points] = True
+        starts = np.concatenate((starts[split], split_points))
+        ends = np.concatenate((split_points, ends[split]))
+
+
+def nearPoints(x, y, px, py, margin):
+    """Returns a mask of the vertices within margin of any of the points px, py"""
+    near = np.zeros(len(x), dtype=bool)
+    for mx, my in zip(px, py):
+        near |= np.hypot(x - mx, y - my) <= margin
+    return near
@@ -0,0 +1,69 @@
+const plotThemes = {
+  light: { font: "#2a3f5f", grid: "#dfe3eb" },
+  dark: { font: "#f2f5fa", grid: "#283442" },
+};
+
+const plotThemeLayout = () => {
+  const colors =
+    plotThemes[document.firstElementChild.getAttribute("data-theme")] ||
+    plotThemes.light;
+  return {
+    "font.color": colors.font,
+    "xaxis.gridcolor": colors.grid,
+    "xaxis.zerolinecolor": colors.grid,
+    "yaxis.gridcolor": colors.grid,
+    "yaxis.zerolinecolor": colors.grid,
+  };
+};
+
+const drawElevationPlots = (spec) => {
+  const plots = [];
+  for (const [key, series] of Object.entries(spec)) {
+    const element = document.getElementById("plot_" + key);
+    if (!element) continue;
+    const traces = [
+      {
+        x: series.poi.dist,
+        y: series.poi.alt,
+        hovertemplate: "Distanz: %{x} m, Höhe: %{y} m",
+        name: "MZB",
+      },
+      {
+        x: series.profile.dist,
+        y: series.profile.alt,
+        hovertemplate: "Distanz: %{x} m, Höhe: %{y} m",
+        name: "Profil",
+      },
+    ];
+    const layout = {
+      xaxis: { title: { text: "Distanz (m)" } },
+      yaxis: { title: { text: "Höhe (m)" } },
+      width: 400,
+      height: 300,
+      margin: { l: 60, r: 10, t: 20, b: 50 },
+      paper_bgcolor: "rgba(0,0,0,0)",
+      plot_bgcolor: "rgba(0,0,0,0)",
+    };
+    Plotly.newPlot(element, traces, layout).then(() =>
+      Plotly.relayout(element, plotThemeLayout())
+    );
+    plots.push(element);
+  }
+
+  // Restyle instead of redrawing when the theme is toggled
+  new MutationObserver(() => {
+    const layout = plotThemeLayout();
+    plots.forEach((element) => Plotly.relayout(element, layout));
+  }).observe(document.firstElementChild, {
+    attributes: true,
+    attributeFilter: ["data-theme"],
+  });
+};
+
+window.addEventListener("DOMContentLoaded", () => {
+  const container = document.querySelector("[data-plot-url]");
+  if (!container) return;
+  fetch(container.getAttribute("data-plot-url"))
+    .then((response) => response.json())
+    .then(drawElevationPlots);
+});
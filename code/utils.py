@@ -1,6 +1,38 @@
+import os
+import threading
 import time
 
+_id_lock = threading.Lock()
+_last_millis = 0
+_sequence = 0
 
-def getCurrentTimeString():
-    time.sleep(0.002)
-    return str(round(time.time() * 1000))
+
+def _resetIdState():
+    global _id_lock, _last_millis, _sequence
+    _id_lock = threading.Lock()
+    _last_millis = 0
+    _sequence = 0
+
+
+os.register_at_fork(after_in_child=_resetIdState)
+
+
+def getUniqueId():
+    """
+    Returns a numeric id string made of the current time in milliseconds,
+    a per-process sequence number and the process id.
+    Ids never repeat within a process and differ between running processes.
+    """
+    global _last_millis, _sequence
+    with _id_lock:
+        millis = round(time.time() * 1000)
+        if millis > _last_millis:
+            _last_millis = millis
+            _sequence = 0
+        else:
+            _sequence += 1
+            if _sequence > 999:
+                # Borrow the next millisecond instead of waiting for it
+                _last_millis += 1
+                _sequence = 0
+        return f"{_last_millis}{_sequence:03d}{os.getpid()}"
@@ -35,6 +35,8 @@
 # Updated 9 dec 2014
 # Please validate your results with NAVREF on-line service: https://www.swisstopo.admin.ch/en/maps-data-online/calculation-services/navref.html (difference ~ 1-2m)
 
+import numpy as np
+
 
 class GPSConverter(object):
     '''
@@ -158,6 +160,36 @@ class GPSConverter(object):
                 self.WGStoCHx(latitude, longitude, clip),
                 self.WGStoCHh(latitude, longitude, ellHeight, clip))
 
+    def LV03toWGS84_batch(self, east, north, height, clip=False):
+        '''
+        Convert arrays of LV03 coordinates to WGS84. Return a tuple of NumPy
+        arrays containing lat, long, and height
+        '''
+        east = np.asarray(east, dtype=float)
+        north = np.asarray(north, dtype=float)
+        height = np.asarray(height, dtype=float)
+        lat = self.CHtoWGSlat(east, north)
+        lng = self.CHtoWGSlng(east, north)
+        h = self.CHtoWGSheight(east, north, height)
+        if clip:
+            return (np.round(lat, 5), np.round(lng, 5), np.round(h))
+        return (lat, lng, h)
+
+    def WGS84toLV03_batch(self, latitude, longitude, ellHeight, clip=False):
+        '''
+        Convert arrays of WGS84 coordinates to LV03. Return a tuple of NumPy
+        arrays containing east, north, and height
+        '''
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        ellHeight = np.asarray(ellHeight, dtype=float)
+        y = self.WGStoCHy(latitude, longitude)
+        x = self.WGStoCHx(latitude, longitude)
+        h = self.WGStoCHh(latitude, longitude, ellHeight)
+        if clip:
+            return (np.round(y), np.round(x), np.round(h))
+        return (y, x, h)
+
 
 if __name__ == "__main__":
     '''Example usage for the GPSConverter class.'''
@@ -0,0 +1,342 @@
+import copy
+import functools
+import io
+import posixpath
+import re
+import zipfile
+from lxml import etree
+
+XLSX_BASE_LOCATION = "files/xlsx/base.xlsx"
+XLSX_SHEET = "leer"
+
+MAIN_NAMESPACE = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PACKAGE_REL_NAMESPACE = "http://schemas.openxmlformats.org/package/2006/relationships"
+WORKBOOK_LOCATION = "xl/workbook.xml"
+WORKBOOK_RELS_LOCATION = "xl/_rels/workbook.xml.rels"
+CONTENT_TYPES_LOCATION = "[Content_Types].xml"
+CONTENT_TYPES_NAMESPACE = "http://schemas.openxmlformats.org/package/2006/content-types"
+
+WORKSHEET_TYPE = f"{REL_NAMESPACE}/worksheet"
+WORKSHEET_CONTENT_TYPE = (
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+)
+# Parts of the sheet which are copied along with it, others like images are shared
+CLONED_TYPES = (f"{REL_NAMESPACE}/drawing", f"{REL_NAMESPACE}/chart")
+
+SHEET_TITLE_LENGTH = 31
+SHEET_TITLE_FORBIDDEN = re.compile(r"[\\\[\]:*?/]")
+
+
+def main(tag):
+    return f"{{{MAIN_NAMESPACE}}}{tag}"
+
+
+def package(tag):
+    return f"{{{PACKAGE_REL_NAMESPACE}}}{tag}"
+
+
+def toBytes(element):
+    return etree.tostring(
+        element, xml_declaration=True, encoding="UTF-8", standalone=True
+    )
+
+
+class XlsxTemplate:
+    """
+    The base workbook, read once. Filling it only touches the XML of one sheet,
+    every other part of the package is copied over as it is, including styles,
+    charts and images.
+    """
+
+    def __init__(self, location=XLSX_BASE_LOCATION, sheet_name=XLSX_SHEET):
+        self.sheet_name = sheet_name
+        with zipfile.ZipFile(location) as zf:
+            self.parts = {info.filename: zf.read(info) for info in zf.infolist()}
+            workbook = etree.fromstring(zf.read(WORKBOOK_LOCATION))
+            rels = etree.fromstring(zf.read(WORKBOOK_RELS_LOCATION))
+
+            sheet = workbook.find(
+                f"{main('sheets')}/{main('sheet')}[@name='{sheet_name}']"
+            )
+            rel_id = sheet.get(f"{{{REL_NAMESPACE}}}id")
+            target = rels.find(f"{package('Relationship')}[@Id='{rel_id}']").get(
+                "Target"
+            )
+            self.sheet_location = "xl/" + target.lstrip("/").removeprefix("xl/")
+            self.sheet = etree.fromstring(zf.read(self.sheet_location))
+
+            # Cached results of formulas would be stale once cells are filled
+            for cell in self.sheet.iter(main("c")):
+                if cell.find(main("f")) is not None:
+                    for value in cell.findall(main("v")):
+                        cell.remove(value)
+            calc = workbook.find(main("calcPr"))
+            if calc is None:
+                calc = etree.SubElement(workbook, main("calcPr"))
+            calc.set("fullCalcOnLoad", "1")
+            self.workbook = toBytes(workbook)
+
+            # Everything but the changed parts, as a complete archive to append to
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as out:
+                for info in zf.infolist():
+                    if info.filename in (WORKBOOK_LOCATION, self.sheet_location):
+                        continue
+                    out.writestr(info, zf.read(info))
+            self.package = buffer.getvalue()
+
+    def fillSheet(self, cells):
+        """Returns a copy of the sheet XML with the given cells set"""
+        sheet = copy.deepcopy(self.sheet)
+        sheet_data = sheet.find(main("sheetData"))
+        rows = {int(row.get("r")): row for row in sheet_data.iter(main("row"))}
+        for ref, value in cells.items():
+            setCell(sheet_data, rows, ref, value)
+        return sheet
+
+    def fill(self, cells):
+        """
+        Returns the bytes of the workbook with the given cells of the sheet set,
+        cells maps references like "A8" to strings or numbers
+        """
+        buffer = io.BytesIO(self.package)
+        with zipfile.ZipFile(buffer, "a", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(WORKBOOK_LOCATION, self.workbook)
+            zf.writestr(self.sheet_location, toBytes(self.fillSheet(cells)))
+        return buffer.getvalue()
+
+    def fillSheets(self, sheets):
+        """
+        Returns the bytes of a workbook with one filled copy of the sheet, including
+        its drawings and charts, per (title, cells) in sheets, in place of the sheet.
+        Titles are made valid and unique sheet names.
+        """
+        parts = dict(self.parts)
+        workbook = etree.fromstring(self.workbook)
+        rels = etree.fromstring(parts[WORKBOOK_RELS_LOCATION])
+        content_types = etree.fromstring(parts[CONTENT_TYPES_LOCATION])
+
+        sheets_element = workbook.find(main("sheets"))
+        template = sheets_element.find(f"{main('sheet')}[@name='{self.sheet_name}']")
+        position = list(sheets_element).index(template)
+        others = [s.get("name") for s in sheets_element if s is not template]
+        titles = sheetTitles([title for title, _ in sheets], others)
+        sheet_id = max(int(s.get("sheetId")) for s in sheets_element) + 1
+
+        previous = template
+        for i, (title, (_, cells)) in enumerate(zip(titles, sheets)):
+            rename = functools.partial(renameSheet, self.sheet_name, title)
+            sheet = self.fillSheet(cells)
+            if i == 0:
+                location = self.sheet_location
+                template.set("name", title)
+                for part in self.linkedParts(location):
+                    parts[part] = rename(parts[part])
+            else:
+                location = posixpath.join(
+                    posixpath.dirname(self.sheet_location), f"mzb_sheet{i}.xml"
+                )
+                self.cloneLinked(
+                    parts, content_types, self.sheet_location, location, i, rename
+                )
+                for view in sheet.iter(main("sheetView")):
+                    view.attrib.pop("tabSelected", None)
+
+                rel_id = f"rIdMzb{i}"
+                etree.SubElement(
+                    rels,
+                    package("Relationship"),
+                    Id=rel_id,
+                    Type=WORKSHEET_TYPE,
+                    Target=posixpath.relpath(location, "xl"),
+                )
+                addOverride(content_types, location, WORKSHEET_CONTENT_TYPE)
+                element = etree.Element(
+                    main("sheet"), name=title, sheetId=str(sheet_id), state="visible"
+                )
+                element.set(f"{{{REL_NAMESPACE}}}id", rel_id)
+                previous.addnext(element)
+                previous = element
+                sheet_id += 1
+            parts[location] = toBytes(sheet)
+
+        # Names local to the sheet are copied for every sheet, later sheets moved back
+        for name in list(workbook.iter(main("definedName"))):
+            local = name.get("localSheetId")
+            if local is None:
+                continue
+            if int(local) > position:
+                name.set("localSheetId", str(int(local) + len(titles) - 1))
+            elif int(local) == position:
+                for i, title in reversed(list(enumerate(titles))):
+                    copied = name if i == 0 else copy.deepcopy(name)
+                    copied.text = renameSheet(
+                        self.sheet_name, title, name.text.encode()
+                    ).decode()
+                    copied.set("localSheetId", str(position + i))
+                    if i:
+                        name.addnext(copied)
+
+        parts[WORKBOOK_LOCATION] = toBytes(workbook)
+        parts[WORKBOOK_RELS_LOCATION] = toBytes(rels)
+        parts[CONTENT_TYPES_LOCATION] = toBytes(content_types)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            # The content types have to come first
+            zf.writestr(CONTENT_TYPES_LOCATION, parts.pop(CONTENT_TYPES_LOCATION))
+            for location, data in parts.items():
+                zf.writestr(location, data)
+        return buffer.getvalue()
+
+    def relationships(self, location):
+        """Returns the relationships of a part which are copied along with it"""
+        rels = self.parts.get(relsLocation(location))
+        if rels is None:
+            return []
+        return [
+            rel
+            for rel in etree.fromstring(rels)
+            if rel.get("Type") in CLONED_TYPES and rel.get("TargetMode") != "External"
+        ]
+
+    def linkedParts(self, location):
+        for rel in self.relationships(location):
+            part = resolveTarget(location, rel.get("Target"))
+            yield part
+            yield from self.linkedParts(part)
+
+    def cloneLinked(self, parts, content_types, source, target, suffix, rename):
+        """
+        Copies the drawings and charts linked from source as the ones of target,
+        applying rename to every copy
+        """
+        rels_location = relsLocation(source)
+        if rels_location not in self.parts:
+            return
+        rels = etree.fromstring(self.parts[rels_location])
+        for rel in rels:
+            if (
+                rel.get("Type") not in CLONED_TYPES
+                or rel.get("TargetMode") == "External"
+            ):
+                continue
+            part = resolveTarget(source, rel.get("Target"))
+            directory, name = posixpath.split(part)
+            clone = posixpath.join(directory, f"mzb{suffix}_{name}")
+            parts[clone] = rename(self.parts[part])
+            addOverride(content_types, clone, contentType(content_types, part))
+            self.cloneLinked(parts, content_types, part, clone, suffix, rename)
+            rel.set("Target", posixpath.relpath(clone, posixpath.dirname(target)))
+        parts[relsLocation(target)] = toBytes(rels)
+
+
+def relsLocation(location):
+    directory, name = posixpath.split(location)
+    return posixpath.join(directory, "_rels", f"{name}.rels")
+
+
+def resolveTarget(location, target):
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(location), target))
+
+
+def contentType(content_types, location):
+    override = content_types.find(
+        f"{{{CONTENT_TYPES_NAMESPACE}}}Override[@PartName='/{location}']"
+    )
+    if override is not None:
+        return override.get("ContentType")
+    extension = posixpath.splitext(location)[1][1:]
+    return content_types.find(
+        f"{{{CONTENT_TYPES_NAMESPACE}}}Default[@Extension='{extension}']"
+    ).get("ContentType")
+
+
+def addOverride(content_types, location, content_type):
+    etree.SubElement(
+        content_types,
+        f"{{{CONTENT_TYPES_NAMESPACE}}}Override",
+        PartName=f"/{location}",
+        ContentType=content_type,
+    )
+
+
+def renameSheet(old, new, data):
+    """Replaces the references to the sheet old in the XML data by ones to new"""
+    quoted = "'" + new.replace("'", "''") + "'"
+    pattern = rf"(?<![\w'])({re.escape(old)}|'{re.escape(old)}')!"
+    return re.sub(pattern.encode(), f"{quoted}!".encode(), data)
+
+
+def sheetTitles(titles, taken=()):
+    """Returns valid sheet names for titles which are unique among themselves and taken"""
+    used = {t.lower() for t in taken}
+    out = []
+    for title in titles:
+        base = SHEET_TITLE_FORBIDDEN.sub("_", title).strip("'").strip() or "Strecke"
+        name = base[:SHEET_TITLE_LENGTH]
+        n = 2
+        while name.lower() in used:
+            suffix = f" ({n})"
+            name = base[: SHEET_TITLE_LENGTH - len(suffix)] + suffix
+            n += 1
+        used.add(name.lower())
+        out.append(name)
+    return out
+
+
+def columnIndex(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index
+
+
+def splitReference(ref):
+    letters, row = re.fullmatch(r"([A-Z]+)(\d+)", ref).groups()
+    return columnIndex(letters), int(row)
+
+
+def setCell(sheet_data, rows, ref, value):
+    column, row_number = splitReference(ref)
+
+    row = rows.get(row_number)
+    if row is None:
+        row = etree.Element(main("row"), r=str(row_number))
+        following = [r for n, r in rows.items() if n > row_number]
+        if following:
+            min(following, key=lambda r: int(r.get("r"))).addprevious(row)
+        else:
+            sheet_data.append(row)
+        rows[row_number] = row
+
+    cell = row.find(f"{main('c')}[@r='{ref}']")
+    if cell is None:
+        cell = etree.Element(main("c"), r=ref)
+        following = [
+            c for c in row.iter(main("c")) if splitReference(c.get("r"))[0] > column
+        ]
+        if following:
+            following[0].addprevious(cell)
+        else:
+            row.append(cell)
+
+    for child in list(cell):
+        cell.remove(child)
+    if isinstance(value, str):
+        cell.set("t", "inlineStr")
+        text = etree.SubElement(etree.SubElement(cell, main("is")), main("t"))
+        text.text = value
+        if value != value.strip():
+            text.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+    else:
+        cell.set("t", "n")
+        etree.SubElement(cell, main("v")).text = str(value)
+
+
+@functools.lru_cache(maxsize=None)
+def getXlsxTemplate():
+    return XlsxTemplate()
@@ -0,0 +1,45 @@
+import time
+import zipfile
+
+
+class ZipStream:
+    """
+    Write only file object for zipfile. Written bytes are collected until they are
+    taken out with drain, zipfile falls back to data descriptors as it cannot seek.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iterZip(entries):
+    """
+    Generates a ZIP archive in chunks of bytes.
+    entries is an iterable of (name, chunks, compress_type), chunks an iterable of bytes.
+    Only the chunk being written is held in memory, never the whole archive.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w") as zf:
+        for name, chunks, compress_type in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = compress_type
+            with zf.open(info, "w") as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+            yield stream.drain()
+    yield stream.drain()